@@ -0,0 +1,184 @@
+__Project__ = "economic_analysis_tools"
+__Description__ = '''Benchmark the data_analysis hot paths on synthetic data and check for regressions against a stored
+    baseline. Run from the repository root, e.g.:
+        python -m benchmarks.run_benchmarks --sizes small medium --output bench_results.json
+        python -m benchmarks.run_benchmarks --sizes small --baseline bench_baseline.json --threshold 0.25'''
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_data import gravity_panel, estimation_results
+from data_analysis.TraderRanking import TraderRanking
+from data_analysis.ZeroDiagnosis import ZeroDiagnosis
+from data_analysis.data_diagnostics import DataDistribution, CompareIdentifiers, check_merge
+from data_analysis.NTM_tools import across_country_ave
+from data_analysis.format_regression_table import format_regression_table
+
+# Panel dimensions (countries, sectors, years) and estimation result dimensions (products, countries, years)
+SIZES = {'small': {'panel': (20, 5, 3), 'results': (5, 20, 3)},
+         'medium': {'panel': (50, 20, 5), 'results': (20, 50, 5)},
+         'large': {'panel': (100, 50, 10), 'results': (100, 100, 10)}}
+
+
+def measure(function, repeat: int = 3):
+    '''
+    Time a function and measure its peak memory allocation.
+    :param function: (callable) A function that takes no arguments.
+    :param repeat: (int) The number of timed runs. The fastest is reported. Default is 3.
+    :return: (dict) The best wall time in seconds and the peak traced memory in megabytes.
+    '''
+    times = list()
+    for run in range(repeat):
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    # Memory is measured on a separate run because tracing slows execution
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 1e6}
+
+
+def benchmark_cases(size: str, zero_share: float = 0.3):
+    '''
+    Create the benchmark cases for a data size.
+    :param size: (str) A key of SIZES.
+    :param zero_share: (float) The share of zero trade flows in the synthetic panel.
+    :return: (Dict[callable]) A dictionary of functions to benchmark keyed by benchmark name.
+    '''
+    countries, sectors, years = SIZES[size]['panel']
+    panel = gravity_panel(countries, sectors, years, zero_share=zero_share)
+    products, fe_countries, fe_years = SIZES[size]['results']
+    results_dict = estimation_results(products, fe_countries, fe_years)
+    pooled_results = estimation_results(products, fe_countries, 1)
+    covariates = panel.drop_duplicates(['importer', 'exporter', 'year']).drop(columns=['sector', 'trade_value'])
+    covariates = covariates.sample(frac=0.9, random_state=0)
+    covariates['distance'] = 1.0
+    # Identifiers with (nearly) one distinct code per row, such as firm or shipment IDs
+    sector_year = panel['sector'] + panel['year'].astype(str)
+    route_codes = pd.DataFrame({'route': panel['importer'] + panel['exporter'] + sector_year,
+                                'reverse': panel['exporter'] + panel['importer'] + sector_year})
+    other_route_codes = route_codes.sample(frac=0.9, random_state=0)
+
+    return {'TraderRanking.ranking': lambda: TraderRanking(panel, sector_var_name='sector').ranking(
+                flow='both', by_year=True, by_sector=True),
+            'TraderRanking.ranking (encode_keys)': lambda: TraderRanking(panel, sector_var_name='sector',
+                                                                         encode_keys=True).ranking(
+                flow='both', by_year=True, by_sector=True),
+            'ZeroDiagnosis.find_zeros': lambda: ZeroDiagnosis(panel, sector_var_name='sector').find_zeros(
+                ['importer', 'exporter', 'year'], drop_obs=True),
+            'ZeroDiagnosis.find_zeros (3 sets)': lambda: ZeroDiagnosis(panel, sector_var_name='sector').find_zeros(
+                [['importer', 'exporter'], ['importer', 'year'], ['exporter', 'year']]),
+            'ZeroDiagnosis.find_zeros (3 sets, encode_keys)': lambda: ZeroDiagnosis(
+                panel, sector_var_name='sector', encode_keys=True).find_zeros(
+                [['importer', 'exporter'], ['importer', 'year'], ['exporter', 'year']]),
+            'ZeroDiagnosis.find_sector_zeros': lambda: ZeroDiagnosis(panel, sector_var_name='sector').find_sector_zeros(
+                [['importer', 'exporter'], ['importer', 'year'], ['exporter', 'year']]),
+            'ZeroDiagnosis.prune_to_fixed_point': lambda: ZeroDiagnosis(panel).prune_to_fixed_point(
+                [['importer', 'year'], ['exporter', 'year'], ['importer', 'exporter']], drop_singletons=True),
+            'DataDistribution': lambda: DataDistribution(panel, include_columns=['importer', 'exporter', 'sector',
+                                                                                 'year']),
+            'DataDistribution (lazy)': lambda: DataDistribution(panel, include_columns=['importer', 'exporter', 'sector',
+                                                                                        'year'], lazy=True).compute(),
+            'CompareIdentifiers': lambda: CompareIdentifiers(panel, covariates, ['importer', 'exporter'],
+                                                             ['importer', 'exporter']),
+            'CompareIdentifiers (many codes)': lambda: CompareIdentifiers(route_codes, other_route_codes,
+                                                                          ['route', 'reverse'], ['route', 'reverse']),
+            'check_merge': lambda: check_merge(panel, covariates, ['importer', 'exporter', 'year'],
+                                               ['importer', 'exporter', 'year']),
+            'across_country_ave': lambda: across_country_ave(results_dict, sigma=5, fixed_effect_prefix='imp_fe',
+                                                             year_by_year=True),
+            'across_country_ave (pooled)': lambda: across_country_ave(pooled_results, sigma=5,
+                                                                      fixed_effect_prefix='imp_fe'),
+            'format_regression_table': lambda: format_regression_table(results_dict,
+                                                                       omit_fe_prefix=['imp_fe_'])}
+
+
+def run_benchmarks(sizes: list = ['small'], repeat: int = 3, zero_share: float = 0.3, benchmarks: list = None):
+    '''
+    Run the benchmark suite.
+    :param sizes: (List[str]) The data sizes (keys of SIZES) to run. Default is ['small'].
+    :param repeat: (int) The number of timed runs of each benchmark. Default is 3.
+    :param zero_share: (float) The share of zero trade flows in the synthetic panel. Default is 0.3.
+    :param benchmarks: (List[str]) (optional) A subset of benchmark names to run. The default runs all of them.
+    :return: (dict) Benchmark results and information about the environment.
+    '''
+    results = dict()
+    for size in sizes:
+        for name, function in benchmark_cases(size, zero_share).items():
+            if benchmarks and name not in benchmarks:
+                continue
+            result = measure(function, repeat)
+            results['{} [{}]'.format(name, size)] = result
+            print('{:<45} {:>10.4f} s {:>10.1f} MB'.format('{} [{}]'.format(name, size), result['seconds'],
+                                                           result['peak_mb']))
+    return {'environment': {'python': platform.python_version(),
+                            'pandas': pd.__version__,
+                            'numpy': np.__version__,
+                            'platform': platform.platform()},
+            'results': results}
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float = 0.25):
+    '''
+    Identify benchmarks that are slower or use more memory than a baseline.
+    :param results: (dict) Output of run_benchmarks().
+    :param baseline: (dict) Output of run_benchmarks() from a previous (baseline) run.
+    :param threshold: (float) The allowed proportional increase over the baseline (e.g. 0.25 for 25%).
+    :return: (List[str]) A list of descriptions of regressions. The list is empty if there are none.
+    '''
+    regressions = list()
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        for measurement in ['seconds', 'peak_mb']:
+            base_value = baseline['results'][name][measurement]
+            if base_value > 0 and result[measurement] > base_value * (1 + threshold):
+                regressions.append('{}: {} increased from {:.4f} to {:.4f} ({:+.0%})'.format(
+                    name, measurement, base_value, result[measurement], result[measurement] / base_value - 1))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the data_analysis tools on synthetic gravity data.')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES.keys()))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--zero-share', type=float, default=0.3)
+    parser.add_argument('--benchmarks', nargs='+', default=None, help='Subset of benchmark names to run.')
+    parser.add_argument('--output', default=None, help='Path of a JSON file in which to record the results.')
+    parser.add_argument('--baseline', default=None, help='Path of a JSON file of baseline results to compare to.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed proportional increase in time or memory over the baseline.')
+    arguments = parser.parse_args(arguments)
+
+    results = run_benchmarks(arguments.sizes, arguments.repeat, arguments.zero_share, arguments.benchmarks)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, arguments.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+__Project__ = "economic_analysis_tools"
+__Description__ = '''Generators of synthetic gravity panels and estimation results for benchmarking.'''
+
+import itertools
+import string
+import numpy as np
+import pandas as pd
+
+
+def country_codes(number_of_countries: int):
+    '''
+    Create a list of unique three letter country codes (AAA, AAB, ...).
+    :param number_of_countries: (int) The number of codes to create.
+    :return: (List[str]) A list of country codes.
+    '''
+    letters = itertools.product(string.ascii_uppercase, repeat=3)
+    return [''.join(code) for code in itertools.islice(letters, number_of_countries)]
+
+
+def gravity_panel(number_of_countries: int = 50,
+                  number_of_sectors: int = 10,
+                  number_of_years: int = 5,
+                  zero_share: float = 0.3,
+                  first_year: int = 2000,
+                  seed: int = 0):
+    '''
+    Create a synthetic bilateral gravity panel with columns importer, exporter, sector, year, and trade_value. Every
+    importer-exporter-sector-year combination is included, so the panel has countries^2 * sectors * years rows.
+    :param number_of_countries: (int) The number of countries. Default is 50.
+    :param number_of_sectors: (int) The number of sectors. Default is 10.
+    :param number_of_years: (int) The number of years. Default is 5.
+    :param zero_share: (float) The share of trade flows that are zero. Default is 0.3.
+    :param first_year: (int) The first year in the panel. Default is 2000.
+    :param seed: (int) The random seed. Default is 0.
+    :return: (DataFrame) A synthetic gravity panel.
+    '''
+    rng = np.random.default_rng(seed)
+    countries = np.array(country_codes(number_of_countries), dtype=object)
+    sectors = np.array(['S{:05d}'.format(number) for number in range(number_of_sectors)], dtype=object)
+    years = np.arange(first_year, first_year + number_of_years)
+    shape = (number_of_countries, number_of_countries, number_of_sectors, number_of_years)
+    importer, exporter, sector, year = np.indices(shape).reshape(4, -1)
+    # Log-normal flows scaled by country size give a realistic, skewed distribution of trade
+    country_size = rng.lognormal(mean=0, sigma=1.5, size=number_of_countries)
+    trade_value = country_size[importer] * country_size[exporter] * rng.lognormal(mean=5, sigma=2,
+                                                                                  size=importer.shape[0])
+    trade_value[rng.random(importer.shape[0]) < zero_share] = 0
+    return pd.DataFrame({'importer': countries[importer],
+                         'exporter': countries[exporter],
+                         'sector': sectors[sector],
+                         'year': years[year],
+                         'trade_value': trade_value})
+
+
+class SyntheticResults(object):
+    def __init__(self,
+                 params: pd.Series,
+                 seed: int = 0):
+        '''
+        A stand-in for a statsmodels GLM results object with the attributes used by across_country_ave() and
+        format_regression_table().
+        Args:
+            params: (pd.Series) Parameter estimates indexed by variable name.
+            seed: (int) The random seed for the remaining statistics.
+        '''
+        rng = np.random.default_rng(seed)
+        self.params = params
+        self.bse = pd.Series(rng.uniform(0.01, 1, params.shape[0]), index=params.index)
+        self.pvalues = pd.Series(rng.uniform(0, 0.2, params.shape[0]), index=params.index)
+        self.nobs = 1000
+        self.aic = float(rng.uniform(100, 1000))
+        self.bic = float(rng.uniform(100, 1000))
+        self.llf = float(rng.uniform(-1000, -100))
+        self.rsquared = float(rng.uniform(0, 1))
+
+
+def estimation_results(number_of_products: int = 10,
+                       number_of_countries: int = 50,
+                       number_of_years: int = 1,
+                       number_of_covariates: int = 5,
+                       fixed_effect_prefix: str = 'imp_fe_',
+                       first_year: int = 2000,
+                       seed: int = 0):
+    '''
+    Create a dictionary of synthetic estimation results, one per product, containing gravity covariates and country or
+    country-year fixed effects (e.g. imp_fe_AAA_2000).
+    :param number_of_products: (int) The number of products (dictionary entries). Default is 10.
+    :param number_of_countries: (int) The number of country fixed effects per year. Default is 50.
+    :param number_of_years: (int) The number of years of fixed effects. Default is 1.
+    :param number_of_covariates: (int) The number of non-fixed effect covariates. Default is 5.
+    :param fixed_effect_prefix: (str) The prefix of the fixed effect names. Default is 'imp_fe_'.
+    :param first_year: (int) The first year of fixed effects. Default is 2000.
+    :param seed: (int) The random seed. Default is 0.
+    :return: (Dict[SyntheticResults]) A dictionary of results keyed by product code.
+    '''
+    rng = np.random.default_rng(seed)
+    covariates = ['covariate_{}'.format(number) for number in range(number_of_covariates)]
+    fixed_effects = ['{}{}_{}'.format(fixed_effect_prefix, country, year)
+                     for country in country_codes(number_of_countries)
+                     for year in range(first_year, first_year + number_of_years)]
+    names = covariates + fixed_effects
+    results_dict = dict()
+    for product in range(number_of_products):
+        params = pd.Series(rng.normal(0, 1, len(names)), index=names)
+        results_dict['{:06d}'.format(product)] = SyntheticResults(params, seed=seed + product)
+    return results_dict
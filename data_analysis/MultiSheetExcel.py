@@ -5,68 +5,201 @@ __Description__ = '''A class for creating and writing multi-sheet excel files.''
 
 # ToDo: Add LaTeX support for output.
 
-from pandas import DataFrame, ExcelWriter
+import os
+from warnings import warn
+from pandas import DataFrame, MultiIndex
+
+EXCEL_MAX_ROWS = 1048576
+_BLOCK_ROWS = 10000
+
+
+def open_workbook(path: str):
+	'''
+	Create an xlsxwriter workbook in constant memory mode, in which each row is flushed to disk once the next row is
+	started. Sheets must therefore be written one at a time and top to bottom, as write_sheet() does.
+	:param path: (str) file path of the 'xlsx' file to create.
+	:return: (xlsxwriter.Workbook) The workbook, which must be closed with workbook.close().
+	'''
+	try:
+		import xlsxwriter
+	except ImportError:
+		raise ImportError('Writing excel files requires xlsxwriter.')
+	return xlsxwriter.Workbook(path, {'constant_memory': True,
+									  'nan_inf_to_errors': True,
+									  'strings_to_urls': False,
+									  'default_date_format': 'yyyy-mm-dd'})
+
+
+def write_sheet(workbook, dataframe, sheet_name: str, index: bool = False, overflow: str = 'truncate',
+				sidecar: str = None, notes: list = None):
+	'''
+	Write a table to a new sheet of an xlsxwriter workbook, a block of rows at a time. Missing values are left blank.
+	:param workbook: (xlsxwriter.Workbook) A workbook, such as one created with open_workbook().
+	:param dataframe: (pandas.DataFrame, str, or callable) The table to write. Alternatively, any source accepted by
+		chunk_io.iter_chunks, such as the path of a CSV or Parquet file or a function returning a DataFrame, which is
+		only read now and is written a chunk at a time.
+	:param sheet_name: (str) Name for the sheet. Names are truncated to excel's limit of 31 characters.
+	:param index: (bool) If True, the index is written as the first column(s). Default is False.
+	:param overflow: (str) How to handle tables with more rows than an excel sheet holds (1,048,576 including the
+		header). 'truncate' (default) writes the rows that fit and warns, 'spill' continues the table on additional
+		sheets named 'sheet_name (2)', 'sheet_name (3)', etc., and 'error' raises a ValueError.
+	:param sidecar: (str) (optional) Either 'csv' or 'parquet'. If a DataFrame does not fit on one sheet, the full
+		table is also written to a file of that type next to the workbook, named after the workbook and sheet.
+	:param notes: (List[(str, str)]) (optional) Labelled notes, e.g. [('Note', 'Values in USD')], written as extra
+		rows below the table with the label in the first column and the note in the second.
+	:return: (List[str]) The names of the sheets written.
+	'''
+	if overflow not in ['truncate', 'spill', 'error']:
+		raise ValueError("overflow must be 'truncate', 'spill', or 'error'.")
+	notes = notes if notes else []
+	rows_per_sheet = EXCEL_MAX_ROWS - 1 - len(notes)
+
+	if isinstance(dataframe, DataFrame):
+		if dataframe.shape[0] > rows_per_sheet:
+			if overflow == 'error':
+				raise ValueError('{} has {} rows, which is more than fit on an excel sheet.'.format(sheet_name,
+																									 dataframe.shape[0]))
+			if sidecar is not None:
+				sidecar_path = '{}_{}.{}'.format(os.path.splitext(workbook.filename)[0], sheet_name, sidecar)
+				if sidecar == 'csv':
+					dataframe.to_csv(sidecar_path, index=index)
+				elif sidecar == 'parquet':
+					dataframe.to_parquet(sidecar_path, index=index)
+				else:
+					raise ValueError("sidecar must be 'csv' or 'parquet'.")
+		chunks = [dataframe]
+	else:
+		try:
+			from data_analysis.chunk_io import iter_chunks
+		except ImportError:
+			from chunk_io import iter_chunks
+		chunks = iter_chunks(dataframe, chunksize=_BLOCK_ROWS * 10)
+
+	header_format = workbook.add_format({'bold': True})
+	sheet_names = list()
+	worksheet = None
+	row_number = 0
+	for header, rows in _row_blocks(chunks, index):
+		while rows:
+			if worksheet is None or row_number > rows_per_sheet:
+				if worksheet is not None and overflow != 'spill':
+					if overflow == 'error':
+						raise ValueError('{} has more rows than fit on an excel sheet.'.format(sheet_name))
+					warn('{} has more than {} rows, so only the first {} are written to excel.'.format(
+						sheet_name, rows_per_sheet, rows_per_sheet))
+					return _write_notes(worksheet, row_number, notes, sheet_names)
+				worksheet = _add_worksheet(workbook, sheet_name, len(sheet_names), header, header_format)
+				sheet_names.append(worksheet.name)
+				row_number = 1
+			fitting = rows[0:rows_per_sheet - row_number + 1]
+			for row in fitting:
+				worksheet.write_row(row_number, 0, row)
+				row_number += 1
+			rows = rows[len(fitting):]
+	if worksheet is None:
+		# An empty table still gets a sheet with its column names (if they are known)
+		header = _header(dataframe.reset_index() if index else dataframe) if isinstance(dataframe, DataFrame) else []
+		worksheet = _add_worksheet(workbook, sheet_name, 0, header, header_format)
+		sheet_names.append(worksheet.name)
+		row_number = 1
+	return _write_notes(worksheet, row_number, notes, sheet_names)
+
+
+def _header(table):
+	return [' '.join(str(level) for level in column) if isinstance(table.columns, MultiIndex) else column
+			for column in table.columns]
+
+
+def _row_blocks(chunks, index):
+	'''
+	Yield the header and a list of row values, with missing values as None, for blocks of rows of each chunk.
+	'''
+	for chunk in chunks:
+		table = chunk.reset_index() if index else chunk
+		header = _header(table)
+		for start in range(0, table.shape[0], _BLOCK_ROWS):
+			block = table.iloc[start:start + _BLOCK_ROWS]
+			values = block.to_numpy(dtype=object)
+			values[block.isna().to_numpy()] = None
+			yield header, values.tolist()
+
+
+def _add_worksheet(workbook, sheet_name, sheet_number, header, header_format):
+	name = sheet_name[0:31] if sheet_number == 0 else '{} ({})'.format(sheet_name[0:25], sheet_number + 1)
+	worksheet = workbook.add_worksheet(name)
+	worksheet.write_row(0, 0, header, header_format)
+	return worksheet
+
+
+def _write_notes(worksheet, row_number, notes, sheet_names):
+	for label, note in notes:
+		worksheet.write_row(row_number, 0, ['{}:'.format(label), note])
+		row_number += 1
+	return sheet_names
 
 
 class MultiSheetExcel():
 	def __init__(self):
 		'''
 		A class for creating multi sheet excel files. Add sheets using obj.add_sheet() and write to disk
-		with obj.write()
+		with obj.write(). Sheets are streamed to disk one at a time, so only one table is held in memory while writing
+		if tables are added as functions or files.
 		'''
 		self.sheet_list = list()
 		self.contents = None
 
-	def add_sheet(self, dataframe, sheet_name: str = None, description: str = '', note: str = None):
+	def add_sheet(self, dataframe, sheet_name: str = None, description: str = '', note: str = None,
+				  index: bool = True):
 		'''
-		Add a sheet to the excel file.
-		:param dataframe: (pandas.DataFrame) The dataframe to be written on the new sheet.
+		Add a sheet to the excel file. The table is not read or copied until the file is written, and sheets are written
+		one at a time, so tables can be supplied as functions or files to avoid holding every table in memory at once.
+		:param dataframe: (pandas.DataFrame, callable, or str) The dataframe to be written on the new sheet, a function
+		that returns it, or the path of a CSV or Parquet file containing it.
 		:param sheet_name: (str) Name for the sheet.
 		:param description: (str) An optional descritption for the sheet to be included on a table of contents.
 		:param note: (str) An optional note to add to the bottom of the table (first column, last row)
+		:param index: (bool) If True (default), the index of the table is written as its first column(s).
 		:return: None
 		'''
+		notes = list()
 		if sheet_name:
-			dataframe = self._add_note(dataframe, 'Sheet', sheet_name)
+			notes.append(('Sheet', sheet_name))
 		if description:
-			dataframe = self._add_note(dataframe,'Description',description)
+			notes.append(('Description', description))
 		if note:
-			dataframe = self._add_note(dataframe, 'Note', note)
+			notes.append(('Note', note))
 		if not sheet_name:
 			sheet_name = 'unnamed_{}'.format(len(self.sheet_list) + 1)
-		self.sheet_list.append({'table': dataframe, 'sheet_name': sheet_name, 'description': description})
-
-	def _add_note(self, df, type, note):
-		note_row = DataFrame(df.iloc[0, :].copy()).transpose()
-		note_row.index = ['{}:'.format(type)]
-		note_row.loc[:, :] = ''
-		note_row.iloc[0, 0] = note
-		return df.append(note_row)
+		self.sheet_list.append({'table': dataframe, 'sheet_name': sheet_name, 'description': description,
+								'notes': notes, 'index': index})
 
-	def write(self, path, table_of_contents: bool = True):
+	def write(self, path, table_of_contents: bool = True, overflow: str = 'truncate', sidecar: str = None):
 		'''
 		Write the multisheet excel
 		:param path: (str) file path to write excel 'xlsx' file.
 		:param table_of_contents: (bool) If true, the file will include a table of contents on the first sheet of that
 		lists the different sheets and any descriptions that were provided.
+		:param overflow: (str) How to handle tables with more rows than fit on a sheet. See write_sheet().
+		:param sidecar: (str) (optional) 'csv' or 'parquet' to also write tables that do not fit on a sheet to a file of
+		that type. See write_sheet().
 		:return: None
 		'''
 		if not path.endswith('xlsx'):
 			path = path + '.xlsx'
-		if table_of_contents:
-			sheet_names = list()
-			descriptions = list()
-			for number, item in enumerate(self.sheet_list):
-				sheet_names.append(item['sheet_name'])
-				descriptions.append(item['description'])
-			title_sheet = DataFrame({'Sheet #': list(range(1, len(sheet_names) + 1)),
-									 'Contents': sheet_names,
-									 'Description': descriptions})
-
-			with ExcelWriter(path) as writer:
-				number = 0
-				if table_of_contents:
-					title_sheet.to_excel(writer, sheet_name='Contents', index=False)
-				for item in self.sheet_list:
-					number = number + 1
-					item['table'].to_excel(writer, sheet_name=('{}. {}'.format(number, item['sheet_name'][0:26])))
+		workbook = open_workbook(path)
+		try:
+			if table_of_contents:
+				sheet_names = list()
+				descriptions = list()
+				for number, item in enumerate(self.sheet_list):
+					sheet_names.append(item['sheet_name'])
+					descriptions.append(item['description'])
+				title_sheet = DataFrame({'Sheet #': list(range(1, len(sheet_names) + 1)),
+										 'Contents': sheet_names,
+										 'Description': descriptions})
+				write_sheet(workbook, title_sheet, 'Contents')
+			for number, item in enumerate(self.sheet_list, start=1):
+				write_sheet(workbook, item['table'], '{}. {}'.format(number, item['sheet_name'][0:26]),
+							index=item['index'], overflow=overflow, sidecar=sidecar, notes=item['notes'])
+		finally:
+			workbook.close()
@@ -1,13 +1,87 @@
+import numpy as np
 import pandas as pd
-import math as math
 from typing import Union
 from warnings import warn
+
+
+class FixedEffectIndex(object):
+    def __init__(self, names, fixed_effect_prefix:str = 'imp_fe'):
+        '''
+        A parsed index of the fixed effects in a list of parameter names, built once so that countries and years can be
+        selected without string operations on each lookup. Fixed effects are names starting with fixed_effect_prefix,
+        followed by a country and optionally a 4 digit year (e.g. imp_fe_USA_2015 or imp_fe_USA2015). Separating
+        underscores are not part of the country.
+        :param names: (list or Index) The parameter names, such as the index of the params of a sm.glm result.
+        :param fixed_effect_prefix: (str) the prefix of the names corresponding to the desired fixed effects
+        '''
+        self.names = pd.Index(names)
+        self.fixed_effect_prefix = fixed_effect_prefix
+        labels = pd.Series(self.names.astype(str), dtype=object)
+        # Positions of the fixed effects within names
+        self.positions = np.flatnonzero(labels.str.startswith(fixed_effect_prefix).to_numpy(dtype=bool))
+        fixed_effects = labels.iloc[self.positions].reset_index(drop=True)
+        has_year = fixed_effects.str[-4:].str.isdigit().to_numpy(dtype=bool) & \
+                   (fixed_effects.str.len().to_numpy() >= len(fixed_effect_prefix) + 4)
+        body = fixed_effects.str[len(fixed_effect_prefix):]
+        # Name without the year, which identifies a country across years
+        self.stems = np.where(has_year, fixed_effects.str[:-4], fixed_effects).astype(object)
+        self.countries = pd.Series(np.where(has_year, body.str[:-4], body), dtype=object).str.strip('_').to_numpy()
+        self.years = np.where(has_year, fixed_effects.str[-4:], None).astype(object)
+        self._country_codes, self._country_labels = pd.factorize(pd.Index(self.countries, dtype=object))
+        self._year_codes, self._year_labels = pd.factorize(pd.Index(self.years, dtype=object))
+
+    def matches(self, names, fixed_effect_prefix:str) -> bool:
+        '''
+        Check whether the index was built for the same parameter names and prefix, in which case it can be reused.
+        :param names: (list or Index) The parameter names.
+        :param fixed_effect_prefix: (str) the prefix of the names corresponding to the desired fixed effects
+        :return: (bool) True if the index can be reused.
+        '''
+        return fixed_effect_prefix == self.fixed_effect_prefix and self.names.equals(pd.Index(names))
+
+    def select(self, countries:list = None, years:list = None):
+        '''
+        Select fixed effects by country and/or year.
+        :param countries: (list) (optional) The countries to keep. Default is None, which keeps all countries.
+        :param years: (list) (optional) The years to keep. Default is None, which keeps all years.
+        :return: (ndarray) The positions, within the fixed effects of the index, of the selected fixed effects, in the
+            order they appear in names.
+        '''
+        mask = np.ones(len(self.positions), dtype=bool)
+        if countries is not None:
+            mask &= self._lookup(self._country_codes, self._country_labels, countries)
+        if years is not None:
+            mask &= self._lookup(self._year_codes, self._year_labels, [str(year) for year in years])
+        return np.flatnonzero(mask)
+
+    def year_groups(self, selected):
+        '''
+        Split selected fixed effects by year.
+        :param selected: (ndarray) Positions of fixed effects, as returned by select().
+        :return: (list) A list of (year, positions) tuples in the order each year first appears. Fixed effects without
+            a year are omitted.
+        '''
+        codes = self._year_codes[selected]
+        groups = []
+        for code in pd.unique(codes[codes >= 0]):
+            groups.append((self._year_labels[code], selected[codes == code]))
+        return groups
+
+    @staticmethod
+    def _lookup(codes, labels, values):
+        wanted = np.zeros(len(labels) + 1, dtype=bool)
+        wanted[:-1] = labels.isin(values)
+        # Missing labels have code -1, which maps to the last, False, entry
+        return wanted[codes]
+
+
 def across_country_ave(results_dict:dict,
                        sigma:Union[float,object],
                        fixed_effect_prefix:str = 'imp_fe',
                        country_list:list = None,
                        year_by_year = False,
-                       format:str = 'long'):
+                       format:str = 'long',
+                       fe_index:FixedEffectIndex = None):
     '''
     A function to calculate ad valorem equivalents according to the methodology described in Fontagne et al. (2011).
     The computed AVEs a relative to the least restrictive/most competitive country based on the estimated fixed effects
@@ -16,6 +90,8 @@ def across_country_ave(results_dict:dict,
     :param sigma: (numeric or DataFrame) a substitution elasticity to be used for the calculation of AVEs. If a
         Dataframe, it should be formatted with two columns corresponding to [sector, sigma] in that order.
     :param fixed_effect_prefix: (str) the prefix of the indexes corresponding to the desired fixed effects
+    :param country_list: (list) (optional) The countries for which to compute AVEs. Countries are matched against the
+        country part of each fixed effect name (e.g. USA in imp_fe_USA_2015).
     :param year_by_year: (bool) Changes treatment of country-year fixed effects,  If True, separates fixed effects by
         year so that AVEs a generated by comparing FEs within the same year. To do so, fixed effects must be
         country-year such that the names have the years as the last 4 characters (e.g. imp_fe_USA_2015).
@@ -23,85 +99,78 @@ def across_country_ave(results_dict:dict,
     :param format: (str) Accepts 'long' (default) or 'wide'. If long, each row is identified by a country, sector, and
         year if applicable. If wide, Rows are identified by country only and each year and sector appears in different
         columns.
+    :param fe_index: (FixedEffectIndex) (optional) A parsed index of the parameter names. It is reused for every product
+        whose parameter names match it, and otherwise one is built and reused for subsequent products with the same
+        names.
     :return: (DataFrame) a Pandas dataframe consisting of the estimated AVEs for each country and sector.
     '''
     # Prep elasticity input if DataFrame
     if isinstance(sigma, pd.DataFrame):
-        elast_dict = {}
-        for row in sigma.index:
-            elast_dict[str(sigma.iloc[row, 0])] = sigma.iloc[row, 1]
-        sigma = elast_dict
+        sigma = dict(zip(sigma.iloc[:, 0].astype(str), sigma.iloc[:, 1]))
 
     list_of_series = []
+    list_of_countries = []
     for product in results_dict.keys():
         # Perform calculation for all years (if applicable) pooled together
 
         # Collect parameter values
-        coeffs = pd.DataFrame(results_dict[product].params)
-        coeffs.rename(columns = {0:"fe_{}".format(str(product))}, inplace = True)
-
-        pvals = pd.DataFrame(results_dict[product].pvalues)
-        pvals.rename(columns = {0:"pval_{}".format(str(product))}, inplace = True)
+        params = results_dict[product].params
+        pvalues = results_dict[product].pvalues
+        if not pvalues.index.equals(params.index):
+            pvalues = pvalues.reindex(params.index)
 
-        coeffs = pd.concat([coeffs, pvals], axis = 1)
-
-        fe_list = [row for row in results_dict[product].params.keys() if row.startswith(fixed_effect_prefix)]
+        # Parse the fixed effect names, reusing the index of the previous product when the names are the same
+        if fe_index is None or not fe_index.matches(params.index, fixed_effect_prefix):
+            fe_index = FixedEffectIndex(params.index, fixed_effect_prefix)
 
         # Collect a subset of countries
-        if country_list is not None:
-            temp_list = []
-            for country in country_list:
-                [temp_list.append(fe) for fe in fe_list if country in fe]
-            fe_list = temp_list
-
-        mask = coeffs.index.isin(fe_list)
-        coeffs = coeffs.loc[mask, :].copy()
+        selected = fe_index.select(countries=country_list)
 
+        coeff_name = "fe_{}".format(str(product))
+        pval_name = "pval_{}".format(str(product))
         if year_by_year:
-            # Split index of fixed effect names into a year and ID component
-            coeffs.reset_index(inplace = True)
-            coeffs['year'] = coeffs['index'].str[-4:]
-            coeffs['index'] = coeffs['index'].str[:-4]
-            coeffs.index = coeffs['index']
-            coeffs.drop(['index'], axis = 1,inplace = True)
-            # Get list off years with fixed effects
-            year_list = coeffs['year'].unique().tolist()
-            for year in year_list:
+            # Split fixed effects by year, identifying them by their name without the year
+            for year, year_selected in fe_index.year_groups(selected):
                 # Create new column names
-                old_coeff_name = "fe_{}".format(str(product))
                 new_coeff_name = "_".join(['fe',product,year])
-                old_pval_name = "pval_{}".format(str(product))
                 new_pval_name = "_".join(['pval',product,year])
                 # Grab estimates relating to the desired year
-                year_subset = coeffs.loc[coeffs['year'] == year,[old_coeff_name, old_pval_name] ].copy()
-                year_subset.rename(columns = {old_coeff_name:new_coeff_name,
-                                              old_pval_name:new_pval_name}, inplace=True)
+                year_subset = pd.DataFrame({new_coeff_name: params.to_numpy()[fe_index.positions[year_selected]],
+                                            new_pval_name: pvalues.to_numpy()[fe_index.positions[year_selected]]},
+                                           index = pd.Index(fe_index.stems[year_selected], name = 'index'))
                 list_of_series.append(year_subset)
+                list_of_countries.append(pd.Series(fe_index.countries[year_selected], index = year_subset.index))
 
                 # expand sigma dictionary to new product-years
                 if isinstance(sigma, dict):
                     sigma[new_coeff_name] = sigma[product]
 
         else:
+            coeffs = pd.DataFrame({coeff_name: params.to_numpy()[fe_index.positions[selected]],
+                                   pval_name: pvalues.to_numpy()[fe_index.positions[selected]]},
+                                  index = params.index[fe_index.positions[selected]])
             list_of_series.append(coeffs)
+            list_of_countries.append(pd.Series(fe_index.countries[selected], index = coeffs.index))
 
     all_imp_fe = pd.concat(list_of_series, join = 'outer', axis = 1)
 
     fe_columns = [col for col in all_imp_fe.columns if col.startswith('fe')]
-    for col in fe_columns:
-        new_col_name = "_".join(['ave', col[3:]])
-        if isinstance(sigma, dict):
-            sigma_value = sigma[col]
-        elif isinstance(sigma, (int, float)):
-            sigma_value = sigma
-        else:
-            raise TypeError('sigma is not a valid type')
-
-        ave = lambda x: math.exp(x / (1 - sigma_value)) - 1
-        max_fe = all_imp_fe[col].max()
-        all_imp_fe[new_col_name] = all_imp_fe[col] - max_fe
-        all_imp_fe[new_col_name] = all_imp_fe[new_col_name].apply(ave)
-        all_imp_fe.loc[:,str('sigma_'+col[3:])] = sigma_value
+    if isinstance(sigma, dict):
+        sigma_values = [sigma[col] for col in fe_columns]
+    elif isinstance(sigma, (int, float)):
+        sigma_values = [sigma] * len(fe_columns)
+    else:
+        raise TypeError('sigma is not a valid type')
+
+    # Compute the AVEs of every fixed effect column at once, relative to the largest fixed effect in each column
+    fe_values = all_imp_fe[fe_columns].to_numpy(dtype=float)
+    max_fe = all_imp_fe[fe_columns].max().to_numpy(dtype=float)
+    aves = np.exp((fe_values - max_fe) / (1 - np.array(sigma_values, dtype=float))) - 1
+    ave_columns = dict()
+    for number, (col, sigma_value) in enumerate(zip(fe_columns, sigma_values)):
+        ave_columns["_".join(['ave', col[3:]])] = aves[:, number]
+        ave_columns[str('sigma_'+col[3:])] = np.full(all_imp_fe.shape[0], sigma_value)
+    all_imp_fe = pd.concat([all_imp_fe, pd.DataFrame(ave_columns, index=all_imp_fe.index)], axis=1)
 
     wide_data = all_imp_fe.copy()
     if format == 'long':
@@ -110,17 +179,19 @@ def across_country_ave(results_dict:dict,
             col_list = [tuple(col.split('_')) for col in all_imp_fe.columns]
             long_data.columns = pd.MultiIndex.from_tuples(col_list)
             long_data = long_data.unstack().reset_index().copy()
+            countries = pd.concat(list_of_countries)
+            countries = countries[~countries.index.duplicated()]
             if year_by_year:
                 long_data.columns = ['type','sector','year','id','value']
                 long_data = long_data.pivot_table(values = 'value',
                                                   index = ['sector','year','id'], columns='type').reset_index()
-                long_data['country'] = long_data['id'].str[-3:]
+                long_data['country'] = long_data['id'].map(countries)
 
             else:
                 long_data.columns = ['type', 'sector', 'id', 'value']
                 long_data = long_data.pivot_table(values='value',
                                                   index=['sector',  'id'], columns='type').reset_index()
-                long_data['country'] = long_data['id'].str[-7:-4]
+                long_data['country'] = long_data['id'].map(countries)
             return_data = long_data
         except:
             warn("Could not convert to long, returned wide instead.")
@@ -4,7 +4,31 @@ __Created__ = "January 28, 2020"
 __Description__ = '''This is a code to pare down a gravity dataset to include only a subset of the most 
     prominent trading countries. This '''
 
+import os
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+def _sector_partial_sums(shared_arrays, row_start, row_stop):
+    '''
+    Sum trade by sector, year, and importer/exporter codes for rows row_start to row_stop of the shared arrays created by
+    TraderRanking._get_parallel_partial_sums(). Runs in a worker process.
+    '''
+    partition = dict()
+    for name, (block_name, dtype, length) in shared_arrays.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        partition[name] = np.ndarray((length,), dtype=dtype, buffer=block.buf)[row_start:row_stop].copy()
+        block.close()
+    partition = pd.DataFrame(partition)
+    partial_sums = list()
+    for country_column in ['importer', 'exporter']:
+        totals = partition.groupby(['sector', 'year', country_column], sort=False).agg(trade_sum=('trade', 'sum'),
+                                                                                      row_count=('trade', 'size'),
+                                                                                      first_row=('row', 'min'))
+        partial_sums.append(totals)
+    return partial_sums
 
 
 class TraderRanking():
@@ -13,17 +37,33 @@ class TraderRanking():
 
     Args:
         gravity_data: (pd.DataFrame) A gravity dataset containing columns corresponding to importer, exporter, and
-            trade values (necessary) and year (optional).
+            trade values (necessary) and year (optional). See TraderRanking.from_chunks() for datasets that do not fit in
+            memory.
         imp_var_name: (str) The column name containing importer identifiers. Default is 'importer'.
         exp_var_name: (str) The column name containing exporter identifiers. Default is 'exporter'
         trade_var_name: (str) The column name containing trade flows. Default is 'trade_value'.
         year_var_name: (str) The column name containing year identifiers. Default is 'year'.
         sector_var_name: (str) (optional) The column name containing sector identifiers.
+        n_jobs: (int) (optional) The number of processes used to compute the sector totals. The data is partitioned by
+            sector and each process reads only its own partition from shared memory. Requires sector_var_name. Use -1
+            for all available cores. Default is None, which uses a single process.
+        encode_keys: (bool) If True, the country, year, and sector identifiers are converted to compact integer codes
+            before any grouping, which reduces memory and computation time for large datasets. Labels are restored in
+            all outputs, which are the same as without encoding. Default is False.
 
     Methods:
-        ranking(flow: str = 'both', by_year: bool = False, by_sector: bool = False)
+        ranking(flow: str = 'both', by_year: bool = False, by_sector: bool = False, long_format: bool = False)
         top_countries(self, flow='both', country_number=None, by_year=False, by_sector=False)
         cumulative_coverage(self, flow='both', cumulative_percentage=None, by_year=False, by_sector = False)
+        membership(self, flow='both', country_number=None, cumulative_percentage=None, by_year=False, by_sector=False,
+                   output='column')
+        update(self, new_rows)
+        retract(self, old_rows)
+        clear_cache(self)
+
+    Rankings are constructed from importer and exporter totals by sector and year, which are computed once when the
+    object is created. Rankings are cached by (flow, by_year, by_sector) so that repeated ranking(), top_countries(), and
+    cumulative_coverage() calls reuse the same aggregation. The cache is cleared whenever gravity_data is replaced.
 
     Returns: A TradeRanking object.
 
@@ -69,50 +109,454 @@ class TraderRanking():
                  exp_var_name: str = 'exporter',
                  trade_var_name: str = 'trade_value',
                  year_var_name: str = 'year',
-                 sector_var_name: str = None):
-        self.gravity_data = gravity_data
+                 sector_var_name: str = None,
+                 n_jobs: int = None,
+                 encode_keys: bool = False):
         self.imp_var_name = imp_var_name
         self.exp_var_name = exp_var_name
         self.trade_var_name = trade_var_name
         self.year_var_name = year_var_name
-        self.year_list = self.gravity_data[self.year_var_name].unique().tolist()
+        self.sector_var_name = sector_var_name
+        self.n_jobs = n_jobs
+        self._encoder = None
+        if encode_keys:
+            try:
+                from data_analysis.key_encoding import KeyEncoder
+            except ImportError:
+                from key_encoding import KeyEncoder
+            self._encoder = KeyEncoder({imp_var_name: 'country', exp_var_name: 'country'})
+        self.gravity_data = gravity_data
+
+    @classmethod
+    def from_chunks(cls,
+                    source,
+                    imp_var_name: str = 'importer',
+                    exp_var_name: str = 'exporter',
+                    trade_var_name: str = 'trade_value',
+                    year_var_name: str = 'year',
+                    sector_var_name: str = None,
+                    n_jobs: int = None,
+                    encode_keys: bool = False,
+                    chunksize: int = 1000000,
+                    **read_kwargs):
+        '''
+        Create a TraderRanking from a gravity dataset that is too large to hold in memory. The data is read in chunks
+        and only the importer and exporter totals for each sector, year, and country are retained. The resulting object
+        supports ranking(), top_countries(), cumulative_coverage(), and membership() but has no gravity_data.
+        Args:
+            source: (str or iterable of DataFrames) A path to a CSV file, a Parquet file, or a directory containing a
+                partitioned Parquet dataset. Alternatively, an iterable of DataFrame chunks.
+            imp_var_name: (str) The column name containing importer identifiers. Default is 'importer'.
+            exp_var_name: (str) The column name containing exporter identifiers. Default is 'exporter'
+            trade_var_name: (str) The column name containing trade flows. Default is 'trade_value'.
+            year_var_name: (str) The column name containing year identifiers. Default is 'year'.
+            sector_var_name: (str) (optional) The column name containing sector identifiers.
+            n_jobs: (int) (optional) The number of processes used to compute the sector totals of each chunk.
+            encode_keys: (bool) If True, identifiers are converted to integer codes. See TraderRanking. Default is False.
+            chunksize: (int) The number of rows to read from file at a time. Default is 1,000,000.
+            read_kwargs: Additional keyword arguments passed to pandas.read_csv when reading a CSV file.
+
+        Returns: A TradeRanking object.
+
+        Examples:
+            >>> hs6_rank = TraderRanking.from_chunks('D:/data/hs6_panel/', sector_var_name='hs6')
+            >>> hs6_rank.cumulative_coverage(flow='both', cumulative_percentage=0.9, by_sector=True)
+        '''
+        try:
+            from data_analysis.chunk_io import iter_chunks
+        except ImportError:
+            from chunk_io import iter_chunks
+        trader_ranking = cls(None, imp_var_name=imp_var_name, exp_var_name=exp_var_name,
+                             trade_var_name=trade_var_name, year_var_name=year_var_name,
+                             sector_var_name=sector_var_name, n_jobs=n_jobs, encode_keys=encode_keys)
+        columns = [imp_var_name, exp_var_name, trade_var_name, year_var_name]
         if sector_var_name:
-            self.sector_var_name = sector_var_name
-            self.sector_list = self.gravity_data[self.sector_var_name].unique().tolist()
+            columns.append(sector_var_name)
+        import_totals = list()
+        export_totals = list()
+        for chunk in iter_chunks(source, columns=columns, chunksize=chunksize, **read_kwargs):
+            chunk_imports, chunk_exports = trader_ranking._get_partial_sums(chunk)
+            import_totals = [trader_ranking._combine_partial_sums(import_totals + [chunk_imports])]
+            export_totals = [trader_ranking._combine_partial_sums(export_totals + [chunk_exports])]
+        trader_ranking._set_partial_sums(import_totals[0], export_totals[0])
+        return trader_ranking
+
+    @property
+    def gravity_data(self):
+        return self._gravity_data
+
+    @gravity_data.setter
+    def gravity_data(self, gravity_data):
+        '''
+        Replacing the gravity data recomputes the importer and exporter totals, refreshes the year and sector lists,
+        and invalidates any cached rankings.
+        '''
+        self._gravity_data = gravity_data
+        if gravity_data is not None:
+            self._set_partial_sums(*self._get_partial_sums(gravity_data))
+
+    def clear_cache(self):
+        '''
+        Discard all cached rankings. Cached rankings are discarded automatically when gravity_data is replaced.
+        '''
+        self._ranking_cache = dict()
+
+    def _get_partial_sums(self, gravity_data):
+        '''
+        A private function that sums trade (and counts rows) by (sector), year, and importer and by (sector), year, and
+        exporter. These totals are the only information about the data needed to construct any of the rankings.
+        '''
+        if self.n_jobs not in [None, 0, 1] and self.sector_var_name:
+            return self._get_parallel_partial_sums(gravity_data)
+        if self._encoder is not None:
+            return self._get_encoded_partial_sums(gravity_data)
+        cell_columns = self._group_columns(by_year=True, by_sector=bool(self.sector_var_name))
+        partial_sums = list()
+        for country_column in [self.imp_var_name, self.exp_var_name]:
+            totals = gravity_data.groupby(cell_columns + [country_column], sort=False,
+                                          dropna=False)[self.trade_var_name].agg(['sum', 'size'])
+            totals.columns = ['trade_sum', 'row_count']
+            totals.index.names = cell_columns + ['country']
+            partial_sums.append(totals)
+        return partial_sums[0], partial_sums[1]
+
+    def _get_encoded_partial_sums(self, gravity_data):
+        '''
+        A private function that computes the same totals as _get_partial_sums() from the integer codes of the key
+        columns. The codes of each (sector, year, country) cell are combined into a single integer key, so the totals
+        are counted with np.bincount rather than a multi-column groupby and the trade values are used in place.
+        '''
+        cell_columns = self._group_columns(by_year=True, by_sector=bool(self.sector_var_name))
+        codes = self._encoder.encode(gravity_data, cell_columns + [self.imp_var_name, self.exp_var_name])
+        trade_values = gravity_data[self.trade_var_name].to_numpy()
+        if trade_values.dtype == object:
+            trade_values = trade_values.astype(float)
+        if trade_values.dtype.kind == 'f' and np.isnan(trade_values).any():
+            # Missing trade values are skipped when summing (as in a groupby) but still count as rows
+            trade_values = np.where(np.isnan(trade_values), 0, trade_values)
+
+        row_count = gravity_data.shape[0]
+        partial_sums = list()
+        for country_column in [self.imp_var_name, self.exp_var_name]:
+            key_columns = cell_columns + [country_column]
+            keys = np.zeros(row_count, dtype=np.int64)
+            key_count = 1
+            for col in key_columns:
+                radix = len(self._encoder.vocabulary(col)) + 1
+                keys = keys * radix + codes[col] + 1
+                key_count *= radix
+                if key_count > row_count:
+                    # Renumber the keys that occur so that they stay smaller than the number of rows
+                    keys, occurring_keys = pd.factorize(keys)
+                    key_count = len(occurring_keys)
+            # Cells are kept in the order in which they first appear in the data, as in a groupby with sort=False
+            first_rows = np.full(key_count, row_count, dtype=np.int64)
+            first_rows[keys[::-1]] = np.arange(row_count - 1, -1, -1)
+            cells = np.flatnonzero(first_rows < row_count)
+            cells = cells[np.argsort(first_rows[cells], kind='stable')]
+            trade_sum = np.bincount(keys, weights=trade_values, minlength=key_count)[cells]
+            if trade_values.dtype.kind in 'iu':
+                trade_sum = trade_sum.astype(trade_values.dtype)
+            index = pd.MultiIndex.from_arrays([codes[col][first_rows[cells]] for col in key_columns],
+                                              names=cell_columns + ['country'])
+            partial_sums.append(pd.DataFrame({'trade_sum': trade_sum,
+                                              'row_count': np.bincount(keys, minlength=key_count)[cells]},
+                                             index=index))
+        return partial_sums[0], partial_sums[1]
+
+    def _get_parallel_partial_sums(self, gravity_data):
+        '''
+        A private function that computes the same totals as _get_partial_sums() using a pool of processes. The key
+        columns are factorized to integer codes (or encoded, if encode_keys is True), sorted by sector, and placed in
+        shared memory along with the trade values. Each process sums a contiguous block of sectors and the results are
+        put back in the order in which the cells first appear in the data, so the output does not depend on the number
+        of processes.
+        '''
+        n_workers = os.cpu_count() if self.n_jobs < 0 else self.n_jobs
+        row_count = gravity_data.shape[0]
+        if self._encoder is not None:
+            codes = self._encoder.encode(gravity_data, [self.sector_var_name, self.year_var_name, self.imp_var_name,
+                                                        self.exp_var_name])
+            sector_codes, year_codes = codes[self.sector_var_name], codes[self.year_var_name]
+            country_codes = np.concatenate([codes[self.imp_var_name], codes[self.exp_var_name]])
+        else:
+            sector_codes, sector_labels = pd.factorize(gravity_data[self.sector_var_name], use_na_sentinel=False)
+            year_codes, year_labels = pd.factorize(gravity_data[self.year_var_name], use_na_sentinel=False)
+            country_codes, country_labels = pd.factorize(pd.concat([gravity_data[self.imp_var_name],
+                                                                    gravity_data[self.exp_var_name]],
+                                                                   ignore_index=True),
+                                                         use_na_sentinel=False)
+        trade_values = gravity_data[self.trade_var_name].to_numpy()
+        if trade_values.dtype == object:
+            trade_values = trade_values.astype(float)
+
+        row_order = np.argsort(sector_codes, kind='stable')
+        sorted_sectors = sector_codes[row_order]
+        columns = {'sector': sorted_sectors,
+                   'year': year_codes[row_order],
+                   'importer': country_codes[:row_count][row_order],
+                   'exporter': country_codes[row_count:][row_order],
+                   'trade': trade_values[row_order],
+                   'row': row_order}
+
+        # Split rows into blocks of whole sectors with roughly equal numbers of rows
+        sector_starts = np.r_[0, np.flatnonzero(np.diff(sorted_sectors)) + 1, row_count]
+        targets = np.linspace(0, row_count, n_workers * 4 + 1)
+        cuts = np.unique(sector_starts[np.searchsorted(sector_starts, targets)])
+
+        shared_blocks = list()
+        try:
+            shared_arrays = dict()
+            for name, values in columns.items():
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                shared_blocks.append(block)
+                np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+                shared_arrays[name] = (block.name, values.dtype.str, values.shape[0])
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(_sector_partial_sums, [shared_arrays] * (len(cuts) - 1),
+                                            cuts[:-1], cuts[1:]))
+        finally:
+            for block in shared_blocks:
+                block.close()
+                block.unlink()
+
+        cell_columns = self._group_columns(by_year=True, by_sector=True)
+        partial_sums = list()
+        for position in [0, 1]:
+            totals = pd.concat([result[position] for result in results])
+            totals = totals.sort_values('first_row', kind='mergesort')
+            sectors, years, countries = [totals.index.get_level_values(level).to_numpy() for level in range(3)]
+            if self._encoder is None:
+                sectors, years = sector_labels.take(sectors), year_labels.take(years)
+                countries = country_labels.take(countries)
+            totals.index = pd.MultiIndex.from_arrays([sectors, years, countries], names=cell_columns + ['country'])
+            partial_sums.append(totals[['trade_sum', 'row_count']])
+        return partial_sums[0], partial_sums[1]
+
+    def _combine_partial_sums(self, partial_sums):
+        '''
+        A private function that adds together a list of importer or exporter totals, keeping the order in which the
+        (sector, year, country) cells first appeared.
+        '''
+        combined = pd.concat(partial_sums)
+        return combined.groupby(level=list(range(combined.index.nlevels)), sort=False, dropna=False).sum()
+
+    def _set_partial_sums(self, import_totals, export_totals, clear_cache: bool = True):
+        '''
+        A private function that stores new importer and exporter totals and refreshes the year and sector lists.
+        '''
+        self._import_totals = import_totals
+        self._export_totals = export_totals
+        cell_index = import_totals.index.append(export_totals.index)
+        self.year_list = self._decode(self.year_var_name, cell_index.unique(level=self.year_var_name)).tolist()
+        if self.sector_var_name:
+            self.sector_list = self._decode(self.sector_var_name,
+                                            cell_index.unique(level=self.sector_var_name)).tolist()
+        if clear_cache:
+            self.clear_cache()
+
+    def update(self, new_rows):
+        '''
+        Add new trade flows (e.g. a new year of data) to the rankings without rebuilding them from the full dataset.
+        Only the rankings of the sectors and/or years that contain new rows are recomputed. gravity_data is not
+        modified.
+        Args:
+            new_rows: (pd.DataFrame) Gravity data with the same columns as the data used to create the object.
+
+        Returns: None
+
+        Examples:
+            >>> two_sector_rank.update(two_sector_panel_2017)
+        '''
+        self._apply_partial_sums(*self._get_partial_sums(new_rows))
+
+    def retract(self, old_rows):
+        '''
+        Remove previously added trade flows (e.g. a batch that is being revised) from the rankings. Only the rankings of
+        the sectors and/or years that contain the removed rows are recomputed. gravity_data is not modified.
+        Args:
+            old_rows: (pd.DataFrame) Gravity data rows that were part of the data used to create or update the object.
+
+        Returns: None
+
+        Examples:
+            >>> two_sector_rank.retract(two_sector_panel_2016_preliminary)
+            >>> two_sector_rank.update(two_sector_panel_2016_revised)
+        '''
+        old_imports, old_exports = self._get_partial_sums(old_rows)
+        self._apply_partial_sums(-old_imports, -old_exports)
+
+    def _apply_partial_sums(self, import_changes, export_changes):
+        '''
+        A private function that adds changes in importer and exporter totals to the stored totals and recomputes the
+        cached rankings of the affected groups. Cells that no longer contain any rows are removed so that the result
+        is the same as a full rebuild.
+        '''
+        updated_totals = list()
+        for totals, changes in [(self._import_totals, import_changes), (self._export_totals, export_changes)]:
+            totals = self._combine_partial_sums([totals, changes])
+            if (totals['row_count'] < 0).any():
+                raise ValueError('Cannot retract rows that are not part of the data.')
+            updated_totals.append(totals.loc[totals['row_count'] > 0, :])
+        self._set_partial_sums(updated_totals[0], updated_totals[1], clear_cache=False)
+
+        changed_cells = import_changes.index.append(export_changes.index)
+        for (flow, by_year, by_sector), cached in self._ranking_cache.items():
+            group_columns = self._group_columns(by_year, by_sector)
+            if not group_columns:
+                long_ranking = self._get_grouped_ranking(flow, group_columns)
+            else:
+                changed_groups = changed_cells.droplevel('country').unique()
+                if len(group_columns) < changed_groups.nlevels:
+                    changed_groups = changed_groups.droplevel([name for name in changed_groups.names
+                                                               if name not in group_columns]).unique()
+                changed_labels = self._decode_groups(changed_groups, group_columns)
+                unchanged = cached['ranking']
+                unchanged = unchanged.loc[~self._group_mask(unchanged, group_columns, changed_labels), :]
+                recomputed = self._get_grouped_ranking(flow, group_columns, changed_groups)
+                long_ranking = pd.concat([unchanged, recomputed], ignore_index=True)
+                long_ranking.sort_values(group_columns, inplace=True, kind='mergesort', ignore_index=True)
+            self._ranking_cache[(flow, by_year, by_sector)] = self._cache_entry(long_ranking, group_columns)
+
+    def _decode(self, column, values):
+        '''
+        A private function that converts integer codes back to labels if encode_keys is True.
+        '''
+        if self._encoder is None:
+            return values
+        return self._encoder.decode(column, values)
+
+    def _valid_codes(self, index, levels):
+        '''
+        A private function returning a boolean array identifying the rows of a coded index without missing identifiers.
+        '''
+        return np.all([index.get_level_values(level).to_numpy() != -1 for level in levels], axis=0)
 
+    def _decode_groups(self, groups, group_columns):
+        '''
+        A private function that converts an Index or MultiIndex of group codes back to labels if encode_keys is True.
+        '''
+        if self._encoder is None:
+            return groups
+        if len(group_columns) == 1:
+            return self._decode(group_columns[0], groups)
+        return pd.MultiIndex.from_arrays([self._decode(col, groups.get_level_values(col)) for col in group_columns])
+
+    def _group_mask(self, data, group_columns, groups):
+        '''
+        A private function returning a boolean array identifying the rows of data (a DataFrame with group columns or a
+        Series/DataFrame with group index levels) that belong to one of the supplied groups.
+        '''
+        if isinstance(data, pd.DataFrame) and all(col in data.columns for col in group_columns):
+            keys = [data[col] for col in group_columns]
+        else:
+            keys = [data.index.get_level_values(col) for col in group_columns]
+        if len(group_columns) == 1:
+            return keys[0].isin(groups)
+        return pd.MultiIndex.from_arrays(keys).isin(groups)
 
-    def _get_ranking(self, gravity_data, flow):
+    def _get_grouped_ranking(self, flow, group_columns, groups=None):
         '''
-        A private function for constructing a ranking given a supplied dataset or subset and a specified flow type.
+        A private function for constructing the rankings of every group (e.g. sector-year cell) at once from the
+        importer and exporter totals. Returns a long DataFrame with the group columns, a 'country' column, and the
+        ranking columns, sorted by group and then from largest to smallest flow within each group. If groups is
+        supplied, only the rankings for those groups are constructed.
         '''
-        total_imports = gravity_data.groupby([self.imp_var_name]).agg({self.trade_var_name: 'sum'})
-        total_imports.rename(columns={self.trade_var_name: 'total_imports'}, inplace=True)
-        total_exports = gravity_data.groupby([self.exp_var_name]).agg({self.trade_var_name: 'sum'})
-        total_exports.rename(columns={self.trade_var_name: 'total_exports'}, inplace=True)
+        keys = group_columns + ['country']
+        import_totals = self._import_totals['trade_sum']
+        export_totals = self._export_totals['trade_sum']
+        if groups is not None:
+            import_totals = import_totals.loc[self._group_mask(import_totals, group_columns, groups)]
+            export_totals = export_totals.loc[self._group_mask(export_totals, group_columns, groups)]
+        if self._encoder is not None:
+            # Missing identifiers are coded -1 and, as with labels, are excluded from the rankings
+            import_totals = import_totals.loc[self._valid_codes(import_totals.index, keys)]
+            export_totals = export_totals.loc[self._valid_codes(export_totals.index, keys)]
+        if flow in ['imports', 'both']:
+            total_imports = import_totals.groupby(level=keys, sort=False).sum().rename('total_imports')
+        if flow in ['exports', 'both']:
+            total_exports = export_totals.groupby(level=keys, sort=False).sum().rename('total_exports')
         if flow == 'both':
             flow_column = 'total_trade'
-            total_trade = pd.merge(left=total_exports, left_index=True,
-                                   right=total_imports, right_index=True, how='outer')
+            total_trade = pd.concat([total_exports, total_imports], axis=1, join='outer')
             total_trade = total_trade.fillna(0)
             total_trade[flow_column] = total_trade['total_exports'] + total_trade['total_imports']
         if flow == 'exports':
             flow_column = 'total_exports'
-            total_trade = total_exports
+            total_trade = total_exports.to_frame()
         if flow == 'imports':
             flow_column = 'total_imports'
-            total_trade = total_imports
+            total_trade = total_imports.to_frame()
 
-        total_trade.sort_values([flow_column], ascending=False, inplace=True)
-        total_value = sum(total_trade[flow_column])
+        total_trade = total_trade.reset_index()
+        if self._encoder is not None:
+            # Codes are numbered in the order labels were first seen, which an update or retraction can change, so
+            # groups are sorted on the position of their label in the sorted vocabulary instead
+            sorted_labels = dict()
+            for col in group_columns:
+                vocabulary = self._encoder.vocabulary(col)
+                sorted_labels[col] = vocabulary.sort_values()
+                total_trade[col] = sorted_labels[col].get_indexer(vocabulary)[total_trade[col].to_numpy()]
+        total_trade.sort_values(group_columns + [flow_column], ascending=[True] * len(group_columns) + [False],
+                                inplace=True, ignore_index=True)
+        if group_columns:
+            grouped_flows = total_trade.groupby(group_columns, sort=False)[flow_column]
+            total_value = grouped_flows.transform('sum')
+            cumulative_value = grouped_flows.cumsum()
+            rank = total_trade.groupby(group_columns, sort=False).cumcount() + 1
+        else:
+            total_value = total_trade[flow_column].sum()
+            cumulative_value = total_trade[flow_column].cumsum()
+            rank = total_trade.index + 1
         total_trade['share'] = total_trade[flow_column] / total_value
-        total_trade['cumulative_share'] = total_trade[flow_column].cumsum() / total_value
-        total_trade['rank'] = total_trade.reset_index().index + 1
+        total_trade['cumulative_share'] = cumulative_value / total_value
+        total_trade['rank'] = rank
+        if self._encoder is not None:
+            for col in group_columns:
+                total_trade[col] = sorted_labels[col].take(total_trade[col].to_numpy())
+            total_trade['country'] = self._decode(self.imp_var_name, total_trade['country'])
         return total_trade
 
-    def ranking(self, flow: str = 'both', by_year: bool = False, by_sector: bool = False):
+    def _group_columns(self, by_year, by_sector):
+        '''
+        A private function returning the columns that define the ranking groups.
+        '''
+        group_columns = list()
+        if by_sector:
+            group_columns.append(self.sector_var_name)
+        if by_year:
+            group_columns.append(self.year_var_name)
+        return group_columns
+
+    def _nest_groups(self, group_values, by_year, by_sector, empty):
+        '''
+        A private function that arranges values keyed by (sector, year) tuples into the nested dictionary structure
+        returned by ranking(), top_countries(), and cumulative_coverage(). Cells without any data receive the value
+        returned by empty().
+        '''
+        if not by_sector:
+            return {yr: group_values.get((yr,), empty()) for yr in self.year_list}
+        if not by_year:
+            return {sec: group_values.get((sec,), empty()) for sec in self.sector_list}
+        return {sec: {yr: group_values.get((sec, yr), empty()) for yr in self.year_list} for sec in self.sector_list}
+
+    def _split_ranking(self, cached, flow, group_columns):
+        '''
+        A private function that splits a long ranking into one DataFrame per group, indexed by country.
+        '''
+        long_ranking = cached['ranking']
+        index_name = self.imp_var_name if flow == 'imports' else self.exp_var_name
+        ranking_columns = [col for col in long_ranking.columns if col not in group_columns]
+        body = long_ranking[ranking_columns].set_index('country')
+        body.index.name = index_name
+        group_frames = {group: body.iloc[start:stop] for group, (start, stop) in cached['bounds'].items()}
+        return group_frames, body.iloc[0:0]
+
+    def ranking(self, flow: str = 'both', by_year: bool = False, by_sector: bool = False, long_format: bool = False):
         '''
         Generate a DataFrame of countries ranked by the desired trade flow (imports, exports, or both) from largest to
-        smallest. The DataFrame also includes data on each countries share of total flows and cumulative share.
+        smallest. The DataFrame also includes data on each countries share of total flows and cumulative share. All
+        sector and/or year rankings are computed together in a single grouped pass over the data.
 
         Args:
             flow: (str) Type of flow to base the ranking on ('imports', 'exports', or 'both'). Default is 'both.
@@ -120,42 +564,80 @@ class TraderRanking():
                 summed across all years. Default is False.
             by_sector: (bool) If True, ranking is compiled on a sector-by-sector basis. If False, ranking reflects total
              flows summed across all sectors. Default is False.
+            long_format: (bool) If True, the rankings are returned as a single long DataFrame with sector and/or year
+                columns (if applicable), a 'country' column, and the ranking columns. Default is False.
 
         Returns:
             (DataFrame or Dict[DataFrame] or Dict[Dict[DataFrame]]) A DataFrame or dictionary of DataFrames containing
             the ranking of countries by the selected flow and some additional related info like each countries share of
             the total and the cumulative share. If by_year or by_sector are selected, the return is a dictionary of
             DataFrames keyed by the sector or year IDs. If both are selected, the return is a dictionary keyed by sector
-            labels containing dictionaries keyed by year labels with DataFrame attributes.
+            labels containing dictionaries keyed by year labels with DataFrame attributes. If long_format is True, a
+            single DataFrame is returned regardless of by_year and by_sector.
         '''
-        if not by_sector:
-            if not by_year:
-                return self._get_ranking(self.gravity_data, flow)
-            if by_year:
-                yearly_dict = dict()
-                for yr in self.year_list:
-                    year_data = self.gravity_data.loc[self.gravity_data[self.year_var_name] == yr, :].copy()
-                    yearly_dict[yr] = self._get_ranking(year_data, flow)
-                return yearly_dict
-        if by_sector:
-            sector_dict = dict()
-            for sec in self.sector_list:
-                sector_data = self.gravity_data.loc[self.gravity_data[self.sector_var_name] == sec, :].copy()
-                if not by_year:
-                    sector_dict[sec] = self._get_ranking(sector_data, flow)
-                if by_year:
-                    yearly_dict = dict()
-                    for yr in self.year_list:
-                        year_data = sector_data.loc[sector_data[self.year_var_name] == yr, :].copy()
-                        yearly_dict[yr] = self._get_ranking(year_data, flow)
-                    sector_dict[sec] = yearly_dict
-            return sector_dict
+        cached = self._cached_ranking(flow, by_year, by_sector)
+        long_ranking = cached['ranking']
+        if long_format:
+            return long_ranking.copy()
+        group_columns = self._group_columns(by_year, by_sector)
+        if not group_columns:
+            total_ranking = long_ranking.set_index('country')
+            total_ranking.index.name = self.imp_var_name if flow == 'imports' else self.exp_var_name
+            return total_ranking
+        group_frames, empty_frame = self._split_ranking(cached, flow, group_columns)
+        return self._nest_groups(group_frames, by_year, by_sector, empty_frame.copy)
 
-    def _top_countries(self, ranking, country_number):
+    def _cached_ranking(self, flow, by_year, by_sector):
         '''
-        A private function for computing and returning the top countries given a supplied ranking.
+        A private function returning the cached long ranking for (flow, by_year, by_sector), computing it if needed.
+        The cache entry also holds the sorted country array, each group's (start, stop) position in it, and the running
+        maximum of the cumulative share used to answer coverage queries with a binary search.
         '''
-        return ranking.index[0:country_number].tolist()
+        key = (flow, by_year, by_sector)
+        if key not in self._ranking_cache:
+            group_columns = self._group_columns(by_year, by_sector)
+            long_ranking = self._get_grouped_ranking(flow, group_columns)
+            self._ranking_cache[key] = self._cache_entry(long_ranking, group_columns)
+        return self._ranking_cache[key]
+
+    def _cache_entry(self, long_ranking, group_columns):
+        '''
+        A private function that builds the cache entry for a long ranking.
+        '''
+        if group_columns:
+            group_positions = long_ranking.groupby(group_columns, sort=False).indices
+            bounds = dict()
+            for group, positions in group_positions.items():
+                if not isinstance(group, tuple):
+                    group = (group,)
+                bounds[group] = (positions[0], positions[-1] + 1)
+            coverage = long_ranking.groupby(group_columns, sort=False)['cumulative_share'].cummax()
+        else:
+            bounds = {(): (0, long_ranking.shape[0])}
+            coverage = long_ranking['cumulative_share'].cummax()
+        return {'ranking': long_ranking,
+                'countries': long_ranking['country'].to_numpy(),
+                'coverage': coverage.to_numpy(),
+                'bounds': bounds}
+
+    def _answer_groups(self, cached, by_year, by_sector, select):
+        '''
+        A private function that applies select(start, stop) to each group in a cached ranking and returns the results in
+        the same nesting as ranking().
+        '''
+        group_values = {group: select(start, stop) for group, (start, stop) in cached['bounds'].items()}
+        if not by_sector and not by_year:
+            return group_values[()]
+        return self._nest_groups(group_values, by_year, by_sector, list)
+
+    def _top_countries(self, cached, start, stop, country_number):
+        '''
+        A private function for returning the top countries of the group occupying positions start to stop of a cached
+        ranking.
+        '''
+        if country_number is not None:
+            stop = min(stop, start + country_number)
+        return cached['countries'][start:stop].tolist()
 
     def top_countries(self, flow:str ='both', country_number:int =None,
                       by_year:bool=False, by_sector:bool=False):
@@ -173,38 +655,20 @@ class TraderRanking():
         list of countries. See .ranking() for a description of the by_year and/or by_sector dictionary nesting.
 
         '''
-        ranking = self.ranking(flow, by_year, by_sector)
-        if not by_sector:
-            if not by_year:
-                return self._top_countries(ranking,country_number)
-            if by_year:
-                yearly_countries = dict()
-                for yr in self.year_list:
-                    yearly_countries[yr] = self._top_countries(ranking[yr], country_number)
-                return yearly_countries
-        if by_sector:
-            sector_dict = dict()
-            for sec in self.sector_list:
-                sec_ranking = ranking[sec]
-                if not by_year:
-                    sector_dict[sec] = self._top_countries(sec_ranking,country_number)
-                if by_year:
-                    year_dict = dict()
-                    for yr in self.year_list:
-                        year_ranking = sec_ranking[yr]
-                        year_dict[yr] = self._top_countries(year_ranking, country_number)
-                    sector_dict[sec] = year_dict
-            return sector_dict
+        cached = self._cached_ranking(flow, by_year, by_sector)
+        return self._answer_groups(cached, by_year, by_sector,
+                                   lambda start, stop: self._top_countries(cached, start, stop, country_number))
 
 
-    def _cumulative_coverage(self, ranking, cumulative_percentage):
+    def _cumulative_coverage(self, cached, start, stop, cumulative_percentage):
         '''
-        A private function for computing a list of countries from s aupplied ranking that combine to cover the supplied
-        cumulative share of trade flows.
+        A private function for computing a list of countries from the group occupying positions start to stop of a cached
+        ranking that combine to cover the supplied cumulative share of trade flows. The number of countries is found by
+        a binary search on the running maximum of the cumulative share.
         '''
-        applicable_rows = ranking.loc[ranking['cumulative_share'] < cumulative_percentage, :]
-        number_of_traders = applicable_rows.shape[0] + 1
-        return ranking.index[0:number_of_traders].tolist()
+        coverage = cached['coverage'][start:stop]
+        number_of_traders = coverage.searchsorted(cumulative_percentage, side='left') + 1
+        return cached['countries'][start:min(stop, start + number_of_traders)].tolist()
 
     def cumulative_coverage(self, flow:str ='both', cumulative_percentage:float =None,
                             by_year:bool =False, by_sector:bool = False):
@@ -223,25 +687,56 @@ class TraderRanking():
         list of countries. See .ranking() for a description of the by_year and/or by_sector dictionary nesting.
 
         '''
-        ranking = self.ranking(flow, by_year, by_sector)
-        if not by_sector:
-            if not by_year:
-                return self._cumulative_coverage(ranking, cumulative_percentage)
-            if by_year:
-                yearly_countries = dict()
-                for yr in self.year_list:
-                    yearly_countries[yr] = self._cumulative_coverage(ranking[yr], cumulative_percentage)
-                return yearly_countries
-        if by_sector:
-            sector_dict = dict()
-            for sec in self.sector_list:
-                sec_ranking = ranking[sec]
-                if not by_year:
-                    sector_dict[sec] = self._cumulative_coverage(sec_ranking, cumulative_percentage)
-                if by_year:
-                    year_dict = dict()
-                    for yr in self.year_list:
-                        year_ranking = sec_ranking[yr]
-                        year_dict[yr] = self._cumulative_coverage(year_ranking, cumulative_percentage)
-                    sector_dict[sec] = year_dict
-            return sector_dict
\ No newline at end of file
+        cached = self._cached_ranking(flow, by_year, by_sector)
+        return self._answer_groups(cached, by_year, by_sector,
+                                   lambda start, stop: self._cumulative_coverage(cached, start, stop,
+                                                                                 cumulative_percentage))
+
+    def membership(self, flow: str = 'both', country_number: int = None, cumulative_percentage: float = None,
+                   by_year: bool = False, by_sector: bool = False, output: str = 'column'):
+        '''
+        Identify the top countries (by number and/or cumulative coverage) for every sector and/or year at once. This
+        is a batched alternative to top_countries() and cumulative_coverage() that avoids building nested dictionaries.
+        Args:
+            flow: (str) Type of flow to base the ranking on ('imports', 'exports', or 'both'). Default is 'both.
+            country_number: (int) (optional) The number of top countries to select in each group.
+            cumulative_percentage: (float) (optional) The combined share of trade that the selected countries in each
+                group must cover (e.g. 0.9 for 90%).
+            by_year: (bool) If True, ranking is compiled on a year-by-year basis. If False, ranking reflects total flows
+                summed across all years. Default is False.
+            by_sector: (bool) If True, ranking is compiled on a sector-by-sector basis. If False, ranking reflects total
+             flows summed across all sectors. Default is False.
+            output: (str) 'column' (default) returns the long ranking (see ranking(long_format=True)) with a boolean
+                'in_top' column and/or 'in_coverage' column. 'index' returns a MultiIndex of the (sector, year, country)
+                combinations that satisfy all of the supplied criteria.
+
+        Returns: (DataFrame or MultiIndex) The membership of each country in each group's selection.
+
+        Examples:
+            >>> top_index = two_sector_rank.membership(country_number=8, by_sector=True, by_year=True, output='index')
+            >>> panel_index = pd.MultiIndex.from_frame(two_sector_panel[['Item', 'year', 'exporter']])
+            >>> top_exporter_panel = two_sector_panel.loc[panel_index.isin(top_index), :]
+        '''
+        if country_number is None and cumulative_percentage is None:
+            raise ValueError('Must supply country_number and/or cumulative_percentage.')
+        if output not in ['column', 'index']:
+            raise ValueError("output must be 'column' or 'index'.")
+
+        cached = self._cached_ranking(flow, by_year, by_sector)
+        long_ranking = cached['ranking'].copy()
+        criteria = list()
+        if country_number is not None:
+            long_ranking['in_top'] = long_ranking['rank'] <= country_number
+            criteria.append('in_top')
+        if cumulative_percentage is not None:
+            # A country is included if the countries ranked above it in its group have not yet reached the coverage
+            previous_coverage = np.roll(cached['coverage'], 1)
+            previous_coverage[long_ranking['rank'].to_numpy() == 1] = -np.inf
+            long_ranking['in_coverage'] = previous_coverage < cumulative_percentage
+            criteria.append('in_coverage')
+        if output == 'column':
+            return long_ranking
+
+        selected = long_ranking.loc[long_ranking[criteria].all(axis=1), self._group_columns(by_year, by_sector)
+                                    + ['country']]
+        return pd.MultiIndex.from_frame(selected)
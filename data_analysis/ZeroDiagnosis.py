@@ -1,5 +1,7 @@
 
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 from pandas import DataFrame
 
@@ -11,7 +13,8 @@ class ZeroDiagnosis(object):
                  imp_var_name:str = 'importer',
                  exp_var_name:str = 'exporter',
                  year_var_name:str = 'year',
-                 sector_var_name:str = None):
+                 sector_var_name:str = None,
+                 encode_keys:bool = False):
         '''
         Identify countries that do not have any non-zero trade flows.
         Args:
@@ -21,10 +24,16 @@ class ZeroDiagnosis(object):
             exp_var_name: (str) The name of the column containing exporter IDs.
             year_var_name: (str) The name of the column containing year IDs.
             sector_var_name: (str) The name of the column containing sector IDs.
+            encode_keys: (bool) If True, the columns used to find zeros are converted to compact integer codes (once per
+                column) and all grouping and dropping is done on the codes. Reported zeros are converted back to the
+                original labels but are ordered by first appearance rather than by label. Default is False.
 
         Attributes:
             modified_data: (pd.DataFrame) A dataframe in which rows of zeros have been dropped by the methods (if
-                specified).
+                specified). Rows keep their original order and index. It is created when first accessed after a drop.
+            kept_rows: (np.ndarray) A boolean array flagging the rows of gravity_data that have not been dropped, or
+                None if no rows have been dropped. It can be used to select the remaining rows (e.g.
+                gravity_data[kept_rows]) without ever creating a filtered copy of the data.
 
         '''
         self.gravity_data = gravity_data
@@ -34,43 +43,248 @@ class ZeroDiagnosis(object):
         self.exp_var_name = exp_var_name
         self.year_var_name = year_var_name
         self.sector_var_name = sector_var_name
+        self.encode_keys = encode_keys
+        self.kept_rows = None
+        self._factorized_data = None
+        self._factorized_columns = dict()
 
-    def find_zeros(self, dimensions:List[str], drop_obs:bool = False):
+    @property
+    def modified_data(self):
+        if self._modified_data is None:
+            # Rows are dropped by updating kept_rows, so the data is only filtered (once) when it is needed
+            if self.kept_rows is None:
+                self._modified_data = self.gravity_data
+            else:
+                self._modified_data = self.gravity_data.loc[self.kept_rows, :]
+        return self._modified_data
+
+    @modified_data.setter
+    def modified_data(self, data):
+        self._modified_data = data
+
+    def _group_codes(self, column):
+        '''
+        A private function returning sorted integer codes (-1 for missing values) and the corresponding unique values
+        of a column of gravity_data. They are computed once per column and shared by every set of dimensions. If
+        encode_keys is True, the codes are the compact codes of a KeyEncoder, numbered in order of first appearance.
+        '''
+        if self._factorized_data is not self.gravity_data:
+            self._factorized_data = self.gravity_data
+            self._factorized_columns = dict()
+            if self.encode_keys:
+                try:
+                    from data_analysis.key_encoding import KeyEncoder
+                except ImportError:
+                    from key_encoding import KeyEncoder
+                self._encoder = KeyEncoder({self.imp_var_name: 'country', self.exp_var_name: 'country'})
+        if column not in self._factorized_columns:
+            if self.encode_keys:
+                column_codes = self._encoder.encode(self.gravity_data, [column])[column]
+                self._factorized_columns[column] = (column_codes, self._encoder.vocabulary(column))
+            else:
+                self._factorized_columns[column] = pd.factorize(self.gravity_data[column], sort=True)
+        return self._factorized_columns[column]
+
+    def find_zeros(self, dimensions:List, drop_obs:bool = False):
         '''
         Find zeros given the specified dimensions.
         Args:
-            dimensions: (List[str]) A list of columns specifying the level at which to check for zero trade. For
-                example, ['importer','exporter'] would look for bilateral pairs that never trade and ['importer','year']
-                would look for importers that never import in a given year.
+            dimensions: (List[str] or List[List[str]]) A list of columns specifying the level at which to check for zero
+                trade. For example, ['importer','exporter'] would look for bilateral pairs that never trade and
+                ['importer','year'] would look for importers that never import in a given year. Several sets of
+                dimensions can be checked at once by supplying a list of lists (e.g. [['importer','exporter'],
+                ['importer','year']]), which reuses the work common to them.
             drop_obs: (bool) if true, the identified rows are dropped from the dataframe in self.modified_data.
 
-        Returns: A dataframe reporting cases in which all trade flows are zero.
+        Returns: A dataframe reporting cases in which all trade flows are zero. If several sets of dimensions are
+            supplied, a dictionary of these keyed by the tuple of dimensions.
 
         '''
-        agg_data = self.gravity_data.groupby(dimensions).agg({self.trade_var_name:['min', 'max', 'sum']}).reset_index()
-        agg_data.columns = ["_".join(x) for x in agg_data.columns.ravel()]
-        [agg_data.rename(columns = {(name+'_'):name}, inplace=True) for name in dimensions]
-        non_trading = (agg_data[self.trade_var_name+'_min'] == 0) & (agg_data[self.trade_var_name+'_max'] == 0) & (agg_data[self.trade_var_name+'_sum'] == 0)
-        if non_trading.any():
-            id_rows = agg_data.loc[non_trading,:]
-        else:
-            id_rows = 'No zero trade cases for this set of dimensions.'
+        if dimensions and isinstance(dimensions[0], (list, tuple)):
+            trade_flags = self._trade_flags()
+            return {tuple(dimension_set): self._find_zeros(list(dimension_set), drop_obs, trade_flags)
+                    for dimension_set in dimensions}
+        return self._find_zeros(dimensions, drop_obs, self._trade_flags())
 
-        if drop_obs:
-            if self.modified_data is None:
-                modified_data = self.gravity_data.copy()
-            if self.modified_data is not None:
-                modified_data = self.modified_data.copy()
-
-            drop_df = id_rows[dimensions].copy()
-            drop_df['drop'] = 1
-            modified_data = modified_data.merge(right = drop_df, how = 'outer', on = dimensions)
-            modified_data = modified_data.loc[modified_data['drop']!= 1,:]
-            modified_data.drop(['drop'],axis = 1, inplace = True)
-            self.modified_data = modified_data.copy()
+    def _trade_flags(self):
+        '''
+        A private function flagging rows with an observed trade flow and rows with a nonzero trade flow.
+        '''
+        trade = self.gravity_data[self.trade_var_name]
+        observed = trade.notna().to_numpy()
+        return observed, observed & (trade != 0).to_numpy()
+
+    def _dimension_groups(self, dimensions):
+        '''
+        A private function returning a group code for each row of gravity_data (-1 for rows with a missing identifier)
+        and the number of groups for a set of dimensions. Groups are numbered in the same (sorted) order as a groupby,
+        or in order of the encoded identifiers if encode_keys is True.
+        '''
+        # Re-factorizing after each column keeps the combined codes small and, because the column codes are ordered,
+        # preserves their order
+        group_codes = None
+        for name in dimensions:
+            column_codes, column_values = self._group_codes(name)
+            if group_codes is None:
+                group_codes = column_codes.astype(np.int64)
+                missing = column_codes == -1
+            else:
+                group_codes, _ = pd.factorize(group_codes * (len(column_values) + 1) + column_codes + 1, sort=True)
+                missing |= column_codes == -1
+        group_codes[~missing], _ = pd.factorize(group_codes[~missing], sort=True)
+        group_codes[missing] = -1
+        return group_codes, group_codes.max(initial=-1) + 1
+
+    def _find_zeros(self, dimensions, drop_obs, trade_flags):
+        group_codes, number_of_groups = self._dimension_groups(dimensions)
+        grouped = group_codes != -1
+        observed, nonzero = trade_flags
+        # A group has zero trade if it has at least one observed flow and none of its flows are nonzero
+        non_trading = (np.bincount(group_codes[grouped & observed], minlength=number_of_groups) > 0) & \
+                      (np.bincount(group_codes[grouped & nonzero], minlength=number_of_groups) == 0)
+        first_rows = np.empty(number_of_groups, dtype=np.int64)
+        first_rows[group_codes[grouped][::-1]] = np.flatnonzero(grouped)[::-1]
+
+        id_rows = DataFrame(index=np.flatnonzero(non_trading))
+        for name in dimensions:
+            column_codes, column_values = self._group_codes(name)
+            id_rows[name] = column_values.take(column_codes[first_rows[non_trading]])
+        trade_dtype = self.gravity_data[self.trade_var_name].dtype
+        for statistic in ['min', 'max', 'sum']:
+            id_rows[self.trade_var_name + '_' + statistic] = np.zeros(id_rows.shape[0], dtype=trade_dtype)
 
+        if id_rows.shape[0] == 0:
+            return 'No zero trade cases for this set of dimensions.'
+        if drop_obs:
+            # Drop the rows of the reported groups directly from their group codes
+            self._drop_rows(grouped & non_trading[np.maximum(group_codes, 0)])
         return id_rows
 
+    def find_sector_zeros(self, dimensions:List, drop_obs:bool = False, n_jobs:int = None):
+        '''
+        Find zeros separately for each sector by adding the sector (sector_var_name) to the dimensions, so that every
+        sector is checked in a single pass over the data.
+        Args:
+            dimensions: (List[str] or List[List[str]]) A list of columns specifying the level at which to check for zero
+                trade within each sector, or a list of several such lists. See find_zeros.
+            drop_obs: (bool) if true, the identified rows are dropped from the dataframe in self.modified_data.
+            n_jobs: (int) (optional) If more than 1, the sectors are split into n_jobs parts that are checked in
+                separate processes. This is only worthwhile for very large panels.
+
+        Returns: (pd.DataFrame, pd.DataFrame) A long report with one row for each zero trade case in each sector, in
+            which the 'dimensions' column lists the dimensions checked, and a summary with the number of rows and the
+            number of zero trade cases for each set of dimensions in each sector.
+
+        Examples:
+            >>> zeros = ZeroDiagnosis(gravity_data, sector_var_name='hs2')
+            >>> report, summary = zeros.find_sector_zeros([['importer', 'exporter'], ['importer', 'year']])
+        '''
+        if self.sector_var_name is None:
+            raise ValueError('sector_var_name must be specified to find zeros by sector.')
+        dimension_sets = dimensions if dimensions and isinstance(dimensions[0], (list, tuple)) else [dimensions]
+        sector_codes, sector_values = self._group_codes(self.sector_var_name)
+
+        if n_jobs is not None and n_jobs > 1:
+            # Sectors are independent, so each process can check a separate subset of the sectors. The processes are
+            # sent the (already computed) integer codes of the identifiers, with missing identifiers as NaN.
+            columns = [self.sector_var_name]
+            for dimension_set in dimension_sets:
+                columns += [name for name in dimension_set if name not in columns]
+            coded_data = DataFrame({name: self._missing_as_nan(name) for name in columns})
+            coded_data[self.trade_var_name] = self.gravity_data[self.trade_var_name].to_numpy()
+            partitions = [np.flatnonzero((sector_codes != -1) & (sector_codes % n_jobs == part))
+                          for part in range(n_jobs)]
+            settings = {'trade_var_name': self.trade_var_name, 'sector_var_name': self.sector_var_name}
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_sector_zero_diagnosis,
+                                            [coded_data.iloc[rows] for rows in partitions],
+                                            [settings] * n_jobs,
+                                            [dimension_sets] * n_jobs,
+                                            [drop_obs] * n_jobs))
+            report = pd.concat([partial_report for partial_report, _ in results], ignore_index=True)
+            # Put the reports of the parts back in order of the sets of dimensions and then the sectors
+            set_numbers = {', '.join(dimension_set): number for number, dimension_set in enumerate(dimension_sets)}
+            report['_set'] = report['dimensions'].map(set_numbers)
+            report = report.sort_values(['_set', self.sector_var_name], kind='stable')
+            report = report.drop(columns=['_set']).reset_index(drop=True)
+            for name in columns:
+                report[name] = self._labels(name, report[name].to_numpy())
+            if drop_obs:
+                dropped = np.zeros(self.gravity_data.shape[0], dtype=bool)
+                for rows, (_, kept_rows) in zip(partitions, results):
+                    if kept_rows is not None:
+                        dropped[rows[~kept_rows]] = True
+                self._drop_rows(dropped)
+        else:
+            report = self._sector_report(dimension_sets, drop_obs)
+        report = self._identifier_dtypes(report)
+
+        sector_rows = np.bincount(sector_codes[sector_codes != -1], minlength=len(sector_values))
+        summary = DataFrame({'rows': sector_rows}, index=pd.Index(sector_values, name=self.sector_var_name))
+        zero_counts = report.groupby([self.sector_var_name, 'dimensions'], sort=False).size().unstack('dimensions')
+        for dimension_set in dimension_sets:
+            name = ', '.join(dimension_set)
+            summary[name] = zero_counts[name].reindex(summary.index).fillna(0).astype(np.int64) \
+                if name in zero_counts.columns else 0
+        return report, summary
+
+    def _identifier_dtypes(self, report):
+        '''
+        A private function giving the identifier columns of a combined report the types they have in the data. Sets of
+        dimensions without a column leave it missing in their rows, in which case integer identifiers (e.g. years) are
+        given the nullable Int64 type rather than becoming floats.
+        '''
+        for name in report.columns:
+            if name not in self.gravity_data.columns or name == self.trade_var_name:
+                continue
+            dtype = self.gravity_data[name].dtype
+            if report[name].dtype == dtype:
+                continue
+            if report[name].notna().all():
+                report[name] = report[name].astype(dtype)
+            elif pd.api.types.is_integer_dtype(dtype):
+                report[name] = report[name].astype('Int64')
+        return report
+
+    def _missing_as_nan(self, column):
+        '''
+        A private function returning the sorted integer codes of a column as floats, with missing identifiers as NaN.
+        '''
+        column_codes, _ = self._group_codes(column)
+        return np.where(column_codes == -1, np.nan, column_codes)
+
+    def _labels(self, column, codes):
+        '''
+        A private function converting codes from _missing_as_nan back to the identifiers of a column.
+        '''
+        _, column_values = self._group_codes(column)
+        codes = np.asarray(codes, dtype=np.float64)
+        labels = pd.Series(np.nan, index=range(len(codes)), dtype=object)
+        present = ~np.isnan(codes)
+        found_values = column_values.take(codes[present].astype(np.int64))
+        labels[present] = np.asarray(found_values, dtype=object)
+        return labels.infer_objects()
+
+    def _sector_report(self, dimension_sets, drop_obs):
+        '''
+        A private function returning the long report of zero trade cases in each sector for several sets of
+        dimensions.
+        '''
+        trade_flags = self._trade_flags()
+        columns = ['dimensions', self.sector_var_name]
+        reports = list()
+        for dimension_set in dimension_sets:
+            columns += [name for name in dimension_set if name not in columns]
+            found_zeros = self._find_zeros([self.sector_var_name] + list(dimension_set), drop_obs, trade_flags)
+            if not isinstance(found_zeros, str):
+                found_zeros.insert(0, 'dimensions', ', '.join(dimension_set))
+                reports.append(found_zeros)
+        statistics = [self.trade_var_name + '_' + statistic for statistic in ['min', 'max', 'sum']]
+        columns += statistics
+        if not reports:
+            return DataFrame(columns=columns).astype({statistic: np.float64 for statistic in statistics})
+        return pd.concat(reports, ignore_index=True).reindex(columns=columns)
+
     def no_intra_trade(self, drop_obs:bool = False):
         '''
         Find cases in which intra-national trade is always zero.
@@ -87,15 +301,117 @@ class ZeroDiagnosis(object):
         return no_intra
 
 
+    def prune_to_fixed_point(self, dimension_sets:List[List[str]], drop_singletons:bool = False):
+        '''
+        Repeatedly drop the rows of groups without any nonzero trade flows (and, optionally, groups with a single trade
+        flow) for several sets of dimensions until there are none left. Dropping one group can leave another group
+        with only zero flows, in the same way that separated fixed effects arise in PPML estimation, so a single pass
+        of find_zeros may not be enough. After the first pass, only the counts of the groups containing dropped rows
+        are updated.
+        Args:
+            dimension_sets: (List[List[str]]) The sets of dimensions at which to check for zero trade. For example,
+                [['importer','year'], ['exporter','year'], ['importer','exporter']] for a PPML estimation with
+                importer-year, exporter-year, and pair fixed effects.
+            drop_singletons: (bool) If true, groups with exactly one observed trade flow are also dropped. Default is
+                False.
+
+        Returns: (pd.DataFrame) A report with one row per iteration, set of dimensions, and reason ('zero' or
+            'singleton') listing the number of groups and rows dropped. A row can be in groups dropped for more than
+            one set of dimensions in the same iteration. The remaining data is in self.modified_data.
+
+        Examples:
+            >>> zeros = ZeroDiagnosis(gravity_data)
+            >>> zeros.prune_to_fixed_point([['importer', 'year'], ['exporter', 'year'], ['importer', 'exporter']])
+            >>> estimation_data = zeros.modified_data
+        '''
+        observed, nonzero = self._trade_flags()
+        kept = np.ones(self.gravity_data.shape[0], dtype=bool) if self.kept_rows is None else self.kept_rows.copy()
+        groupings = list()
+        for dimensions in dimension_sets:
+            group_codes, number_of_groups = self._dimension_groups(dimensions)
+            grouped = group_codes != -1
+            # Sort the rows by group so the rows of any group can be found without scanning the data
+            rows = np.flatnonzero(grouped)
+            rows = rows[np.argsort(group_codes[rows], kind='stable')]
+            group_starts = np.concatenate([[0], np.cumsum(np.bincount(group_codes[grouped],
+                                                                      minlength=number_of_groups))])
+            counted = grouped & kept
+            groupings.append({'dimensions': ', '.join(dimensions),
+                              'group_codes': group_codes,
+                              'rows': rows,
+                              'group_starts': group_starts,
+                              'observed': np.bincount(group_codes[counted & observed], minlength=number_of_groups),
+                              'nonzero': np.bincount(group_codes[counted & nonzero], minlength=number_of_groups)})
+
+        report = list()
+        iteration = 0
+        while True:
+            iteration += 1
+            dropped = np.zeros(self.gravity_data.shape[0], dtype=bool)
+            for grouping in groupings:
+                zero_groups = (grouping['observed'] > 0) & (grouping['nonzero'] == 0)
+                reasons = [('zero', zero_groups)]
+                if drop_singletons:
+                    reasons.append(('singleton', (grouping['observed'] == 1) & ~zero_groups))
+                for reason, flagged in reasons:
+                    groups = np.flatnonzero(flagged)
+                    if len(groups) == 0:
+                        continue
+                    group_rows = _rows_of_groups(grouping['rows'], grouping['group_starts'], groups)
+                    group_rows = group_rows[kept[group_rows]]
+                    dropped[group_rows] = True
+                    report.append({'iteration': iteration, 'dimensions': grouping['dimensions'], 'reason': reason,
+                                   'groups': len(groups), 'rows': len(group_rows)})
+            dropped_rows = np.flatnonzero(dropped)
+            if len(dropped_rows) == 0:
+                break
+            kept[dropped_rows] = False
+            for grouping in groupings:
+                dropped_codes = grouping['group_codes'][dropped_rows]
+                in_group = dropped_codes != -1
+                np.subtract.at(grouping['observed'], dropped_codes[in_group & observed[dropped_rows]], 1)
+                np.subtract.at(grouping['nonzero'], dropped_codes[in_group & nonzero[dropped_rows]], 1)
+
+        self._drop_rows(~kept)
+        return DataFrame(report, columns=['iteration', 'dimensions', 'reason', 'groups', 'rows'])
+
     def _drop_obs(self, found_zeros, dimensions):
-        if self.modified_data is None:
-            modified_data = self.gravity_data.copy()
-        if self.modified_data is not None:
-            modified_data = self.modified_data.copy()
-
-        drop_df = found_zeros[dimensions].copy()
-        drop_df['drop'] = 1
-        modified_data = modified_data.merge(right=drop_df, how='outer', on=dimensions)
-        modified_data = modified_data.loc[modified_data['drop'] != 1, :]
-        modified_data.drop(['drop'], axis=1, inplace=True)
-        self.modified_data = modified_data.copy()
\ No newline at end of file
+        '''
+        A private function that drops the rows of gravity_data matching the identifiers in found_zeros. The identifiers
+        are looked up in the (cached) integer codes of each column rather than merged with the data.
+        '''
+        row_count = self.gravity_data.shape[0]
+        keys = np.zeros(row_count + found_zeros.shape[0], dtype=np.int64)
+        for name in dimensions:
+            column_codes, column_values = self._group_codes(name)
+            found_codes = pd.Index(column_values).get_indexer(found_zeros[name])
+            keys, _ = pd.factorize(keys * (len(column_values) + 1) + np.concatenate([column_codes, found_codes]) + 1)
+        self._drop_rows(pd.Series(keys[:row_count]).isin(keys[row_count:]).to_numpy())
+
+    def _drop_rows(self, dropped):
+        '''
+        A private function that removes rows from modified_data given a boolean array flagging the rows of gravity_data
+        to drop.
+        '''
+        if dropped.any():
+            self.kept_rows = ~dropped if self.kept_rows is None else self.kept_rows & ~dropped
+            self._modified_data = None
+
+
+def _rows_of_groups(rows, group_starts, groups):
+    '''
+    Return the rows of each of the groups given the rows sorted by group and the position at which each group starts.
+    '''
+    lengths = group_starts[groups + 1] - group_starts[groups]
+    offsets = np.repeat(group_starts[groups] - np.cumsum(lengths) + lengths, lengths)
+    return rows[offsets + np.arange(lengths.sum())]
+
+
+def _sector_zero_diagnosis(gravity_data, settings, dimension_sets, drop_obs):
+    '''
+    Find the zeros in each sector of part of a gravity dataset. This is a module level function so that it can be run
+    in a separate process.
+    '''
+    diagnosis = ZeroDiagnosis(gravity_data, **settings)
+    report = diagnosis._sector_report(dimension_sets, drop_obs)
+    return report, diagnosis.kept_rows
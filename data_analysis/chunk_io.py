@@ -0,0 +1,60 @@
+__Project__ = "economic_analysis_tools"
+__Description__ = '''Helpers for reading large datasets in chunks from CSV or Parquet files.'''
+
+import os
+import pandas as pd
+
+
+def iter_chunks(source,
+                columns: list = None,
+                chunksize: int = 1000000,
+                **read_kwargs):
+    '''
+    Iterate over a dataset in chunks of rows so that it never needs to be held in memory all at once.
+    :param source: (str, DataFrame, or iterable of DataFrames) A path to a CSV file, a Parquet file, or a directory
+        containing a (possibly hive-partitioned) Parquet dataset. A DataFrame is yielded as a single chunk and an
+        iterable of DataFrames is passed through. A function that returns an iterable of DataFrames may also be
+        supplied, which allows the same source to be read more than once.
+    :param columns: (list of str's) (optional) A subset of columns to read.
+    :param chunksize: (int) The (maximum) number of rows in each chunk read from file. Default is 1,000,000.
+    :param read_kwargs: Additional keyword arguments passed to pandas.read_csv (e.g. dtype or sep).
+    :return: A generator of DataFrames.
+    '''
+    if callable(source):
+        source = source()
+    if isinstance(source, pd.DataFrame):
+        yield source if columns is None else source[columns]
+    elif isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if os.path.isdir(path) or path.endswith(('.parquet', '.pq')):
+            yield from _iter_parquet(path, columns, chunksize)
+        else:
+            with pd.read_csv(path, usecols=columns, chunksize=chunksize, **read_kwargs) as reader:
+                yield from reader
+    else:
+        for chunk in source:
+            yield chunk if columns is None else chunk[columns]
+
+
+def _iter_parquet(path, columns, chunksize):
+    try:
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise ImportError('Reading Parquet files in chunks requires pyarrow.')
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns, batch_size=chunksize):
+        yield batch.to_pandas()
+
+
+def source_size(source):
+    '''
+    Return the size in bytes of a file or directory of files, or None if the source is not a path.
+    :param source: (str) A path to a file or directory.
+    :return: (int or None) The total size in bytes.
+    '''
+    if not isinstance(source, (str, os.PathLike)):
+        return None
+    path = os.fspath(source)
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
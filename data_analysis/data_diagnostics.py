@@ -3,9 +3,14 @@ __Project__ = "economic_analysis_tools"
 __Created__ = "November 12, 2019"
 __Description__ = '''Tools for performing routine data cleaning and diagnostic checks.'''
 
+import copy
+import numpy as np
 import pandas as pd
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pandas import DataFrame
 from typing import List
+from functools import reduce
 
 '''
 dataset = estimation_data_dynamic
@@ -17,22 +22,235 @@ year_list = [1989, 1990]
 def check_merge(dataset_a,
                 dataset_b,
                 merge_dimensions_a: list = [],
-                merge_dimensions_b: list = []):
+                merge_dimensions_b: list = [],
+                key_only: bool = False):
     '''
-    A function to check the quality of a merge and return a dataset of unmatched observations (similar to stata _merge = 1 or 2). Also prints a summary of the missing, unmerged values.
+    A function to check the quality of a merge and return a dataset of unmatched observations (similar to stata _merge = 1 or 2). Also prints a summary of the unmerged values.
     :param dataset_a: (Pandas DataFrame) Fist of the merging datasets
     :param dataset_b: (Pandas DataFrame) Second of the merging datasets.
     :param merge_dimensions_a: (list of str's) A list containing the column names (str) upon which to merge in dataset_a
     :param merge_dimensions_b: (list of str's) A list containing the column names (str) upon which to merge in dataset_b
-    :return: A dataset of unmatched rows in either or both datasets.
+    :param key_only: (bool) If True, only the merge keys are compared and the merged dataset is never constructed, which
+        greatly reduces memory use for large datasets. The printed summary also reports many-to-many keys. The returned
+        rows are the unmatched rows of each dataset (with their own columns) rather than rows of the merged dataset.
+        Default is False.
+    :return: A dataset of unmatched rows in either or both datasets with a '_merge' column indicating whether each row
+        is 'left_only' (dataset_a) or 'right_only' (dataset_b).
     '''
-    merged_data = dataset_a.merge(right=dataset_b, how='outer', left_on=merge_dimensions_a, right_on=merge_dimensions_b)
-    missing_observations = merged_data.isnull().sum()
-    print(missing_observations)
-    unmerged = merged_data[merged_data.isnull().any(axis=1)]
+    if key_only:
+        codes_a, codes_b = _merge_key_codes(dataset_a, dataset_b, merge_dimensions_a, merge_dimensions_b)
+        key_count = max(codes_a.max(initial=-1), codes_b.max(initial=-1)) + 1
+        rows_per_key_a = np.bincount(codes_a, minlength=key_count)
+        rows_per_key_b = np.bincount(codes_b, minlength=key_count)
+        print(_merge_summary(rows_per_key_a, rows_per_key_b))
+        unmatched_a = dataset_a.iloc[np.flatnonzero(rows_per_key_b[codes_a] == 0)].assign(_merge='left_only')
+        unmatched_b = dataset_b.iloc[np.flatnonzero(rows_per_key_a[codes_b] == 0)].assign(_merge='right_only')
+        unmerged = pd.concat([unmatched_a, unmatched_b])
+        return unmerged[[col for col in unmerged.columns if col != '_merge'] + ['_merge']]
+
+    merged_data = dataset_a.merge(right=dataset_b, how='outer', left_on=merge_dimensions_a, right_on=merge_dimensions_b,
+                                  indicator=True)
+    print(merged_data['_merge'].value_counts())
+    unmerged = merged_data.loc[merged_data['_merge'] != 'both', :]
     return unmerged
 
 
+def merge_summary(dataset_a,
+                  dataset_b,
+                  merge_dimensions_a: list = [],
+                  merge_dimensions_b: list = []):
+    '''
+    Summarize how two datasets would merge without merging them, similar to a tabulation of stata's _merge variable.
+    :param dataset_a: (Pandas DataFrame) Fist of the merging datasets
+    :param dataset_b: (Pandas DataFrame) Second of the merging datasets.
+    :param merge_dimensions_a: (list of str's) A list containing the column names (str) upon which to merge in dataset_a
+    :param merge_dimensions_b: (list of str's) A list containing the column names (str) upon which to merge in dataset_b
+    :return: (Pandas DataFrame) The number of distinct keys, rows of each dataset, and rows of the merged dataset that are
+        left_only (_merge = 1), right_only (_merge = 2), and matched (_merge = 3), as well as the number of keys and
+        rows involved in many-to-many matches.
+    '''
+    codes_a, codes_b = _merge_key_codes(dataset_a, dataset_b, merge_dimensions_a, merge_dimensions_b)
+    key_count = max(codes_a.max(initial=-1), codes_b.max(initial=-1)) + 1
+    return _merge_summary(np.bincount(codes_a, minlength=key_count), np.bincount(codes_b, minlength=key_count))
+
+
+def _merge_key_codes(dataset_a, dataset_b, merge_dimensions_a, merge_dimensions_b):
+    '''
+    Assign an integer code to each distinct merge key in either dataset. Missing values are treated as matching each
+    other, as in pandas.merge.
+    '''
+    if not isinstance(merge_dimensions_a, list):
+        merge_dimensions_a = [merge_dimensions_a]
+    if not isinstance(merge_dimensions_b, list):
+        merge_dimensions_b = [merge_dimensions_b]
+    if len(merge_dimensions_a) != len(merge_dimensions_b):
+        raise ValueError('merge_dimensions_a and merge_dimensions_b must contain the same number of columns.')
+    if len(merge_dimensions_a) == 0:
+        raise ValueError('At least one merge dimension must be given.')
+    rows_a = dataset_a.shape[0]
+    key_codes = np.zeros(rows_a + dataset_b.shape[0], dtype=np.int64)
+    for col_a, col_b in zip(merge_dimensions_a, merge_dimensions_b):
+        column_codes, column_values = pd.factorize(pd.concat([dataset_a[col_a], dataset_b[col_b]], ignore_index=True),
+                                                   use_na_sentinel=False)
+        # Combine with the codes of the previous columns and re-factorize so the codes stay small
+        key_codes, _ = pd.factorize(key_codes * len(column_values) + column_codes)
+    return key_codes[:rows_a], key_codes[rows_a:]
+
+
+def _merge_summary(rows_per_key_a, rows_per_key_b):
+    '''
+    Tabulate merge results from the number of rows with each key in each dataset.
+    '''
+    in_a = rows_per_key_a > 0
+    in_b = rows_per_key_b > 0
+    many_to_many = (rows_per_key_a > 1) & (rows_per_key_b > 1)
+    categories = {'left_only (1)': in_a & ~in_b, 'right_only (2)': ~in_a & in_b, 'matched (3)': in_a & in_b,
+                  'many-to-many': many_to_many}
+    summary = pd.DataFrame({'keys': [int(mask.sum()) for mask in categories.values()],
+                            'rows_a': [int(rows_per_key_a[mask].sum()) for mask in categories.values()],
+                            'rows_b': [int(rows_per_key_b[mask].sum()) for mask in categories.values()]},
+                           index=list(categories.keys()))
+    merged_rows = np.maximum(rows_per_key_a, 1) * np.maximum(rows_per_key_b, 1)
+    summary['merged_rows'] = [int(merged_rows[mask].sum()) for mask in categories.values()]
+    return summary
+
+
+
+
+def check_merge_chunked(source_a,
+                        source_b,
+                        merge_dimensions_a: list = [],
+                        merge_dimensions_b: list = [],
+                        output_path: str = None,
+                        build_side: str = None,
+                        chunksize: int = 1000000,
+                        **read_kwargs):
+    '''
+    A version of check_merge for datasets that are too large to hold in memory. The merge keys of one dataset (the
+    smaller one, by default) are hashed to 64-bit integers and held in memory. The other dataset is then streamed in
+    chunks and its unmatched rows are written to output_path as they are found. Finally, the first dataset is streamed
+    again to write its own unmatched rows. Prints and returns a summary of match rates.
+    :param source_a: (str, DataFrame, or iterable of DataFrames) The first of the merging datasets. Can be a path to a
+        CSV file, Parquet file, or Parquet directory, or anything accepted by chunk_io.iter_chunks(). The dataset used
+        to build the key set is read twice, so it must be a path, a DataFrame, or a function returning chunks.
+    :param source_b: (str, DataFrame, or iterable of DataFrames) The second of the merging datasets.
+    :param merge_dimensions_a: (list of str's) A list containing the column names (str) upon which to merge in dataset_a
+    :param merge_dimensions_b: (list of str's) A list containing the column names (str) upon which to merge in dataset_b
+    :param output_path: (str) (optional) A path at which to write a csv file of unmatched rows from both datasets, with
+        a '_merge' column indicating whether each row is 'left_only' (dataset_a) or 'right_only' (dataset_b).
+        Non-key columns that appear in both datasets are suffixed with _x and _y as in pandas.merge.
+    :param build_side: (str) 'a' or 'b', the dataset whose keys are held in memory. By default, the smaller file is
+        used if both are paths and dataset_b otherwise.
+    :param chunksize: (int) The number of rows to read at a time. Default is 1,000,000.
+    :param read_kwargs: Additional keyword arguments passed to pandas.read_csv (e.g. dtype). Numeric keys match
+        whether they are read as integers or floats, but a key read as a string never matches a numeric key.
+    :return: (Pandas DataFrame) The number of rows, matched rows, unmatched rows, and match rate of each dataset.
+    '''
+    if not isinstance(merge_dimensions_a, list):
+        merge_dimensions_a = [merge_dimensions_a]
+    if not isinstance(merge_dimensions_b, list):
+        merge_dimensions_b = [merge_dimensions_b]
+    if len(merge_dimensions_a) != len(merge_dimensions_b):
+        raise ValueError('merge_dimensions_a and merge_dimensions_b must contain the same number of columns.')
+    if len(merge_dimensions_a) == 0:
+        raise ValueError('At least one merge dimension must be given.')
+    try:
+        from data_analysis.chunk_io import iter_chunks, source_size
+    except ImportError:
+        from chunk_io import iter_chunks, source_size
+    if build_side is None:
+        size_a, size_b = source_size(source_a), source_size(source_b)
+        build_side = 'a' if size_a is not None and size_b is not None and size_a < size_b else 'b'
+    sides = {'a': {'source': source_a, 'keys': merge_dimensions_a, 'label': 'left_only'},
+             'b': {'source': source_b, 'keys': merge_dimensions_b, 'label': 'right_only'}}
+    build = sides[build_side]
+    probe = sides['b' if build_side == 'a' else 'a']
+
+    # Build the sorted set of hashed keys of the build dataset
+    key_hashes = list()
+    for chunk in iter_chunks(build['source'], chunksize=chunksize, **read_kwargs):
+        build.setdefault('columns', chunk.columns.tolist())
+        key_hashes.append(np.unique(_hash_keys(chunk, build['keys'])))
+    build_keys = np.unique(np.concatenate(key_hashes)) if key_hashes else np.array([], dtype=np.uint64)
+    matched_build_keys = np.zeros(build_keys.shape[0], dtype=bool)
+
+    writer = _UnmatchedWriter(output_path, sides)
+    for side, stage in [(probe, 'probe'), (build, 'build')]:
+        side['rows'] = 0
+        side['unmatched'] = 0
+        for chunk in iter_chunks(side['source'], chunksize=chunksize, **read_kwargs):
+            side.setdefault('columns', chunk.columns.tolist())
+            hashes = _hash_keys(chunk, side['keys'])
+            positions = np.minimum(np.searchsorted(build_keys, hashes), max(build_keys.shape[0] - 1, 0))
+            if stage == 'probe':
+                matched = (build_keys[positions] == hashes) if build_keys.shape[0] > 0 else np.zeros(hashes.shape,
+                                                                                                  dtype=bool)
+                matched_build_keys[positions[matched]] = True
+            else:
+                matched = matched_build_keys[positions]
+            side['rows'] += chunk.shape[0]
+            side['unmatched'] += int((~matched).sum())
+            writer.write(chunk.loc[~matched, :], side)
+
+    summary = pd.DataFrame({'rows': [sides[name]['rows'] for name in ['a', 'b']],
+                            'unmatched_rows': [sides[name]['unmatched'] for name in ['a', 'b']]},
+                           index=['dataset_a', 'dataset_b'])
+    summary.insert(1, 'matched_rows', summary['rows'] - summary['unmatched_rows'])
+    summary['match_rate'] = summary['matched_rows'] / summary['rows'].where(summary['rows'] > 0)
+    print(summary)
+    return summary
+
+
+_MISSING_KEY_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _hash_keys(chunk, merge_dimensions):
+    '''
+    Hash the merge key columns of each row to a 64-bit integer. Keys are hashed in a canonical form so that the hash
+    does not depend on the dtype a chunk happened to be read with: numeric keys are hashed as float64 (e.g. a chunk of
+    integers containing a missing value is read as float) and missing values of any type share a single hash.
+    '''
+    column_hashes = dict()
+    for number, col in enumerate(merge_dimensions):
+        values = chunk[col]
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            # Adding 0.0 maps -0.0 to 0.0, which compare equal in a merge
+            hashes = pd.util.hash_array(values.to_numpy(dtype=np.float64, na_value=np.nan) + 0.0)
+        else:
+            hashes = pd.util.hash_array(values.to_numpy())
+        hashes[values.isna().to_numpy()] = _MISSING_KEY_HASH
+        column_hashes[number] = hashes
+    return pd.util.hash_pandas_object(pd.DataFrame(column_hashes, index=chunk.index), index=False).to_numpy()
+
+
+class _UnmatchedWriter(object):
+    '''
+    Appends unmatched rows from either dataset to a single csv file with a common set of columns.
+    '''
+    def __init__(self, path, sides):
+        self.path = path
+        self.sides = sides
+        self.columns = None
+
+    def _set_columns(self):
+        columns_a = self.sides['a'].get('columns', [])
+        columns_b = self.sides['b'].get('columns', [])
+        shared_keys = [col for col_a, col in zip(self.sides['a']['keys'], self.sides['b']['keys']) if col_a == col]
+        overlap = [col for col in columns_b if col in columns_a and col not in shared_keys]
+        self.sides['a']['rename'] = {col: col + '_x' for col in overlap}
+        self.sides['b']['rename'] = {col: col + '_y' for col in overlap}
+        renamed_a = [self.sides['a']['rename'].get(col, col) for col in columns_a]
+        renamed_b = [self.sides['b']['rename'].get(col, col) for col in columns_b]
+        self.columns = renamed_a + [col for col in renamed_b if col not in renamed_a] + ['_merge']
+        pd.DataFrame(columns=self.columns).to_csv(self.path, index=False)
+
+    def write(self, rows, side):
+        if self.path is None:
+            return None
+        if self.columns is None:
+            self._set_columns()
+        rows = rows.rename(columns=side['rename']).assign(_merge=side['label'])
+        rows.reindex(columns=self.columns).to_csv(self.path, mode='a', header=False, index=False)
 
 
 def missing_data_subset(dataset):
@@ -50,8 +268,12 @@ def importer_exporter_year_subset(dataset,
                                   year_var_name: str = 'year',
                                   importer_list: list = [],
                                   exporter_list: list = [],
-                                  year_list: list = []):
+                                  year_list: list = [],
+                                  subset_index = None):
     # add checks for typing with year as it could be str or int
+    if subset_index is not None:
+        # Use a prebuilt SubsetIndex of the dataset rather than scanning every column
+        return subset_index.subset(importer_list=importer_list, exporter_list=exporter_list, year_list=year_list)
     data_subset = dataset
     if len(importer_list) > 0:
         data_subset = data_subset.loc[data_subset[importer_var_name].isin(importer_list)]
@@ -62,6 +284,126 @@ def importer_exporter_year_subset(dataset,
     return data_subset
 
 
+class SubsetIndex(object):
+    def __init__(self,
+                 dataset:DataFrame,
+                 importer_var_name: str = 'importer',
+                 exporter_var_name: str = 'exporter',
+                 year_var_name: str = 'year',
+                 sector_var_name: str = None):
+        '''
+        An index of a gravity dataset for quickly and repeatedly selecting rows by importer, exporter, year, and
+        (optionally) sector. Each column is factorized once and the row positions are grouped by value, so a query only
+        touches the rows of the requested values rather than scanning the whole dataset.
+        Args:
+            dataset: (pd.DataFrame) The dataset to index.
+            importer_var_name: (str) The column containing importer IDs. Default is 'importer'.
+            exporter_var_name: (str) The column containing exporter IDs. Default is 'exporter'.
+            year_var_name: (str) The column containing years. Default is 'year'.
+            sector_var_name: (str) (optional) The column containing sector IDs.
+        Methods:
+            positions(self, importer_list=None, exporter_list=None, year_list=None, sector_list=None)
+                Returns a sorted array of the row positions matching the query. Empty or missing lists do not restrict
+                the selection.
+            subset(self, importer_list=None, exporter_list=None, year_list=None, sector_list=None)
+                Returns the matching rows of the dataset.
+            positions_many(self, queries) and subset_many(self, queries)
+                Run a list or dictionary of queries, each a dictionary of the above arguments.
+
+        Examples:
+            >>> index = SubsetIndex(gravity_data)
+            >>> usmca_2015 = index.subset(importer_list=['USA', 'CAN', 'MEX'], exporter_list=['USA', 'CAN', 'MEX'],
+                                          year_list=[2015])
+            >>> queries = {name: {'importer_list': members, 'exporter_list': members} for name, members in regions.items()}
+            >>> regional_data = index.subset_many(queries)
+        '''
+        self.dataset = dataset
+        self._columns = {'importer_list': importer_var_name,
+                         'exporter_list': exporter_var_name,
+                         'year_list': year_var_name}
+        if sector_var_name:
+            self._columns['sector_list'] = sector_var_name
+        self._indexes = dict()
+        for argument, column in self._columns.items():
+            codes, values = pd.factorize(dataset[column])
+            row_order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[row_order], np.arange(len(values) + 1))
+            self._indexes[argument] = {'values': values, 'codes': codes, 'row_order': row_order, 'bounds': bounds}
+
+    def positions(self,
+                  importer_list: list = None,
+                  exporter_list: list = None,
+                  year_list: list = None,
+                  sector_list: list = None):
+        '''
+        Find the positions of the rows matching a query.
+        :param importer_list: (list) (optional) Importers to select.
+        :param exporter_list: (list) (optional) Exporters to select.
+        :param year_list: (list) (optional) Years to select.
+        :param sector_list: (list) (optional) Sectors to select (requires sector_var_name).
+        :return: (np.ndarray) A sorted array of row positions, for use with dataset.iloc or numpy arrays.
+        '''
+        query = {'importer_list': importer_list, 'exporter_list': exporter_list, 'year_list': year_list,
+                 'sector_list': sector_list}
+        requested = dict()
+        for argument, values in query.items():
+            if values is None or len(values) == 0:
+                continue
+            if argument not in self._indexes:
+                raise ValueError('{} requires the index to be built with the corresponding column.'.format(argument))
+            codes = self._indexes[argument]['values'].get_indexer(pd.Index(values).unique())
+            requested[argument] = codes[codes >= 0]
+        if not requested:
+            return np.arange(self.dataset.shape[0])
+
+        # Collect the rows of the most selective dimension, then filter them using the others
+        row_counts = {argument: int(np.diff(self._indexes[argument]['bounds'])[codes].sum())
+                      for argument, codes in requested.items()}
+        first = min(row_counts, key=row_counts.get)
+        index = self._indexes[first]
+        candidates = np.concatenate([index['row_order'][index['bounds'][code]:index['bounds'][code + 1]]
+                                     for code in requested[first]] + [np.array([], dtype=np.intp)])
+        for argument, codes in requested.items():
+            if argument == first:
+                continue
+            selected_codes = np.zeros(len(self._indexes[argument]['values']), dtype=bool)
+            selected_codes[codes] = True
+            candidates = candidates[selected_codes[self._indexes[argument]['codes'][candidates]]]
+        candidates.sort()
+        return candidates
+
+    def subset(self,
+               importer_list: list = None,
+               exporter_list: list = None,
+               year_list: list = None,
+               sector_list: list = None):
+        '''
+        Select the rows of the dataset matching a query. See positions() for a description of the arguments.
+        :return: (pd.DataFrame) The selected rows.
+        '''
+        return self.dataset.iloc[self.positions(importer_list, exporter_list, year_list, sector_list)]
+
+    def positions_many(self, queries):
+        '''
+        Find the row positions for several queries.
+        :param queries: (list or dict) A list or dictionary of queries, each a dictionary of arguments to positions().
+        :return: (list or dict) Arrays of row positions in the same structure as queries.
+        '''
+        if isinstance(queries, dict):
+            return {name: self.positions(**query) for name, query in queries.items()}
+        return [self.positions(**query) for query in queries]
+
+    def subset_many(self, queries):
+        '''
+        Select the rows of the dataset for several queries.
+        :param queries: (list or dict) A list or dictionary of queries, each a dictionary of arguments to positions().
+        :return: (list or dict) DataFrames in the same structure as queries.
+        '''
+        if isinstance(queries, dict):
+            return {name: self.dataset.iloc[positions] for name, positions in self.positions_many(queries).items()}
+        return [self.dataset.iloc[positions] for positions in self.positions_many(queries)]
+
+
 
 '''
 dataframe_a = itpd_pare
@@ -111,38 +453,49 @@ class CompareIdentifiers(object):
         Methods:
             summary(self):
                 Prints basic summary information
+            suggest_matches(self, concordance, concordance_columns, ngram, top_n, min_similarity, all_candidates):
+                Suggests codes in b for unmatched codes in a using a concordance and string similarity
         '''
         if not isinstance(code_columns_a, list):
             code_columns_a = [code_columns_a]
         if not isinstance(code_columns_b, list):
             code_columns_b = [code_columns_b]
 
-        codes_a = set()
-        for col in code_columns_a:
-            temp = dataframe_a[col].unique().tolist()
-            codes_a = codes_a.union(set(temp))
-
-        self.codes_a = list(codes_a)
-
-        codes_b = set()
-        for col in code_columns_b:
-            temp = dataframe_b[col].unique().tolist()
-            codes_b = codes_b.union(set(temp))
+        # Give each distinct code of each column an integer ID shared by both datasets
+        values_a = [pd.Series(dataframe_a[col].unique()) for col in code_columns_a]
+        values_b = [pd.Series(dataframe_b[col].unique()) for col in code_columns_b]
+        rows_a = sum(len(column_values) for column_values in values_a)
+        ids, labels = pd.factorize(pd.concat(values_a + values_b, ignore_index=True), use_na_sentinel=False)
+        del values_a, values_b
+        all_codes = np.asarray(labels, dtype=object)
+        in_a = np.zeros(len(all_codes), dtype=bool)
+        in_a[ids[:rows_a]] = True
+        in_b = np.zeros(len(all_codes), dtype=bool)
+        in_b[ids[rows_a:]] = True
+        del ids
 
-        self.codes_b = list(codes_b)
+        # Sort the distinct codes once, with any missing code last. Python's sort compares strings much faster than a
+        # NumPy object sort.
+        missing = pd.isna(all_codes)
+        try:
+            order = sorted(np.flatnonzero(~missing).tolist(), key=all_codes.__getitem__)
+        except TypeError:
+            # Codes of mixed types cannot be compared, so keep them in order of appearance
+            order = np.flatnonzero(~missing).tolist()
+        order = np.array(order + np.flatnonzero(missing).tolist(), dtype=np.int64)
+        all_codes, labels, in_a, in_b = all_codes[order], labels.take(order), in_a[order], in_b[order]
 
-        self.a_not_in_b = list(codes_a - codes_b)
-        self.b_not_in_a = list(codes_b - codes_a)
-        self.in_both = list(codes_a.intersection(codes_b))
-        self.in_either = list(codes_a.union(codes_b))
+        self.codes_a = all_codes[in_a].tolist()
+        self.codes_b = all_codes[in_b].tolist()
+        self.a_not_in_b = all_codes[in_a & ~in_b].tolist()
+        self.b_not_in_a = all_codes[in_b & ~in_a].tolist()
+        self.in_both = all_codes[in_a & in_b].tolist()
+        self.in_either = all_codes.tolist()
 
-        merge_a = pd.DataFrame(list(codes_a), columns = ['code_a'])
-
-        merge_b = pd.DataFrame(list(codes_b), columns = ['code_b'])
-
-
-        self.code_merge = merge_a.merge(merge_b, how = 'outer', left_on = ['code_a'], right_on=['code_b'])
-        self.unmatched_a = self.code_merge.loc[self.code_merge['code_b'].isnull(),:]
+        # The columns keep the type of the codes, with the usual upcasting (e.g. integers to floats) for missing codes
+        labels = pd.Series(labels)
+        self.code_merge = pd.DataFrame({'code_a': labels.where(in_a), 'code_b': labels.where(in_b)})
+        self.unmatched_a = self.code_merge.loc[self.code_merge['code_b'].isnull(), :]
         self.unmatched_b = self.code_merge.loc[self.code_merge['code_a'].isnull(), :]
         self.unmatched = pd.concat([self.unmatched_a, self.unmatched_b])
 
@@ -159,6 +512,100 @@ class CompareIdentifiers(object):
             print(text)
         return None
 
+    def suggest_matches(self,
+                        concordance: DataFrame = None,
+                        concordance_columns: List[str] = None,
+                        ngram: int = 3,
+                        top_n: int = 1,
+                        min_similarity: float = 0.6,
+                        all_candidates: bool = False):
+        '''
+        Suggest matches in dataframe_b for the codes in dataframe_a that are not in dataframe_b. Codes are first mapped
+        through an optional concordance and any that remain are compared to the codes in dataframe_b by string
+        similarity, measured as the Dice coefficient of the codes' sets of character n-grams (twice the number of shared
+        n-grams divided by the total number). The codes are indexed by n-gram, so only pairs of codes that share an
+        n-gram are scored, and all pairs are scored at once with a sparse matrix product.
+        Args:
+            concordance: (optional) (Pandas DataFrame)
+                A table mapping codes in a to codes in b (e.g. ISO3 to UN M49 or one HS revision to another).
+            concordance_columns: (optional) (List[str])
+                The names of the [a, b] columns in concordance. The default is its first two columns.
+            ngram: (int)
+                The length of the character n-grams used to compare codes. The default is 3.
+            top_n: (int)
+                The maximum number of similarity based suggestions for each code. The default is 1.
+            min_similarity: (float)
+                The minimum similarity, between 0 and 1, of a reported suggestion. The default is 0.6.
+            all_candidates: (bool)
+                If True, any code in dataframe_b can be suggested by similarity. If False (default), only codes in b that
+                are not in a are suggested.
+        Returns: (Pandas DataFrame)
+            A DataFrame with columns code_a, suggestion, similarity, and method ('concordance' or 'similarity'), with
+            one row per suggestion. Codes without a suggestion are omitted.
+
+        Examples:
+            >>> compare = CompareIdentifiers(trade_data, tariff_data, 'product', 'product')
+            >>> compare.suggest_matches(concordance=hs_concordance, concordance_columns=['hs2012', 'hs2017'])
+        '''
+        unmatched = pd.Series(self.a_not_in_b, dtype=object).dropna()
+        suggestions = []
+
+        if concordance is not None:
+            if concordance_columns is None:
+                concordance_columns = concordance.columns[:2].tolist()
+            col_a, col_b = concordance_columns
+            mapped = concordance.loc[concordance[col_a].isin(unmatched) & concordance[col_b].isin(self.codes_b),
+                                     [col_a, col_b]].drop_duplicates()
+            mapped.columns = ['code_a', 'suggestion']
+            mapped['similarity'] = 1.0
+            mapped['method'] = 'concordance'
+            suggestions.append(mapped)
+            unmatched = unmatched[~unmatched.isin(mapped['code_a'])]
+
+        candidates = pd.Series(self.codes_b if all_candidates else self.b_not_in_a, dtype=object).dropna().tolist()
+        unmatched = unmatched.tolist()
+        similar = []
+        if candidates and unmatched:
+            from scipy import sparse
+            # Binary code by n-gram matrices. The n-grams of a code are taken in order (not as a set) so that the
+            # columns, and so the results, do not depend on Python's string hashing.
+            ngram_columns = dict()
+            matrices = []
+            for codes in [candidates, unmatched]:
+                rows, columns = [], []
+                for row, code in enumerate(codes):
+                    for gram in dict.fromkeys(_ngrams(str(code), ngram)):
+                        rows.append(row)
+                        columns.append(ngram_columns.setdefault(gram, len(ngram_columns)))
+                matrices.append((rows, columns, len(codes)))
+            matrix_b, matrix_a = [sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, columns)),
+                                                    shape=(row_count, len(ngram_columns)))
+                                  for rows, columns, row_count in matrices]
+            ngrams_a, ngrams_b = np.diff(matrix_a.indptr), np.diff(matrix_b.indptr)
+            matrix_b = matrix_b.T.tocsr()
+
+            # The product has an entry for each pair of codes that share an n-gram. It is computed for blocks of codes
+            # in a to bound its size.
+            block_rows = max(1, _SUGGEST_BLOCK_PAIRS // len(candidates))
+            for block_start in range(0, len(unmatched), block_rows):
+                shared = (matrix_a[block_start:block_start + block_rows] @ matrix_b).tocoo()
+                score = 2 * shared.data / (ngrams_a[shared.row + block_start] + ngrams_b[shared.col])
+                kept = score >= min_similarity
+                rows, positions, score = shared.row[kept], shared.col[kept], score[kept]
+                # Rank each code's candidates by similarity, with ties going to the candidate listed first
+                order = np.lexsort((positions, -score, rows))
+                rows, positions, score = rows[order], positions[order], score[order]
+                starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+                rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+                top = rank < top_n
+                similar.extend(zip([unmatched[row] for row in rows[top] + block_start],
+                                   [candidates[position] for position in positions[top]], score[top].tolist()))
+        similar = pd.DataFrame(similar, columns=['code_a', 'suggestion', 'similarity'])
+        similar['method'] = 'similarity'
+        suggestions.append(similar)
+
+        return pd.concat(suggestions, ignore_index=True)
+
     def __repr__(self):
         strg = self._summary_text
         return "{} \n"\
@@ -168,13 +615,28 @@ class CompareIdentifiers(object):
                "{} ".format(strg[0],strg[1],strg[2],strg[3],strg[4])
 
 
+def _ngrams(text, n):
+    '''
+    The overlapping character n-grams of text, or text itself if it is shorter than n.
+    '''
+    if len(text) <= n:
+        return [text]
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+_SKETCH_SLICE_ROWS = 1000000
+_SUGGEST_BLOCK_PAIRS = 5000000
+
 
 class DataDistribution(object):
     def __init__(self,
                  data:DataFrame = None,
                  exclude_columns:List[str] = None,
                  include_columns:List[str] = None,
-                 percentiles:List[float] = None):
+                 percentiles:List[float] = None,
+                 lazy:bool = False,
+                 n_jobs:int = None,
+                 sketch_threshold:int = None):
         '''
         A class to provide distribution information about each code in each column. For each column, a table of counts
         and string length is generated for each value in the column. It can also output to an excel workbook.
@@ -187,6 +649,18 @@ class DataDistribution(object):
             include_columns: (List[str])
                 (optional) A list of columns to include in the distribution analysis. The default is to include all
                 columns.
+            lazy: (bool)
+                If True, data is neither copied nor cast to strings. Values keep their native types, string lengths
+                are computed only for the unique values, and each column's distribution is computed the first time it
+                is accessed. The default is False.
+            n_jobs: (int)
+                (optional) The number of threads used to compute the distributions of several columns at once when
+                lazy is True (see compute). The default is to compute them one at a time.
+            sketch_threshold: (int)
+                (optional) Used with lazy=True. Columns with more than sketch_threshold distinct values are summarized
+                with mergeable sketches (see data_analysis.sketches.ColumnSketch) instead of a full frequency table.
+                Their distributions then contain approximate counts of the most frequent values only. The default is to
+                tabulate every column exactly.
         Attributes:
             columns: (list)
                 A list of columns with distributional info.
@@ -194,20 +668,47 @@ class DataDistribution(object):
                 A dictionary keyed by the column names that contains each columns' distribution info as a DataFrame.
             values: (Dict[list])
                 A dictionary keyed by column names containing lists of the unique values in each respective column.
+            description: (DataFrame)
+                Summary statistics of the data from DataFrame.describe.
+            sketches: (Dict[ColumnSketch])
+                A dictionary keyed by column name containing the sketch of each computed column when sketch_threshold
+                is used. These provide distinct counts (sketches[col].distinct()) and quantiles
+                (sketches[col].quantile(q)) for any column.
         Methods:
-            to_excel(self, path)
+            from_chunks(cls, source, exclude_columns, include_columns, percentiles, sketch_threshold, chunksize)
+                Creates a DataDistribution from a file or iterable of chunks that does not fit in memory.
+            partial(source, exclude_columns, include_columns, sketch_threshold, chunksize)
+                Summarizes part of a dataset as a mergeable DistributionPartial.
+            from_partials(cls, partials, percentiles)
+                Creates a DataDistribution from DistributionPartial objects.
+            compute(self, columns)
+                Computes the distributions of the columns (default all) that have not yet been computed when lazy is
+                True, in parallel if n_jobs is more than 1.
+            to_excel(self, path, overflow, sidecar)
                 Args:
                     path: (str)
                         A location and filename at which to create a excel workbook in which each distrobution is stored
                         on a sheet. The path should terminate in an ".xlsx" extension.
+                    overflow: (str)
+                        How to handle distributions with more rows than fit on a sheet: 'truncate' (default), 'spill'
+                        onto additional sheets, or 'error'.
+                    sidecar: (str)
+                        (optional) 'csv' or 'parquet' to also write distributions that do not fit on a sheet to a file
+                        of that type next to the workbook.
         Exmaples:
         >>> test_data = pd.DataFrame({'Name':['Ted', 'Ted', 'Nancy'], 'Age':[35, 32, 12]})
         >>> test_dd = DataDistribution(data=test_data)
         >>> print(test_dd.distributions['Name'])
         >>> test_dd.to_excel('P:\Desktop\\test_distrobution.xlsx')
-        '''
 
-        self._data = data.copy()
+        Compute only the distributions that are used, without copying a large dataset
+        >>> large_dd = DataDistribution(data=large_data, lazy=True, n_jobs=8)
+        >>> print(large_dd.distributions['product'])
+
+        Summarize near-unique columns approximately
+        >>> sketch_dd = DataDistribution(data=large_data, lazy=True, sketch_threshold=100000)
+        >>> print(sketch_dd.sketches['trade_value'].distinct(), sketch_dd.sketches['trade_value'].quantile(0.5))
+        '''
 
         if include_columns:
             using_columns = include_columns
@@ -217,20 +718,146 @@ class DataDistribution(object):
             else:
                 using_columns = [col for col in data.columns.tolist() if col not in exclude_columns]
 
+        if sketch_threshold is not None and not lazy:
+            raise ValueError('sketch_threshold can only be used with lazy=True.')
+
         self.columns = using_columns
-        self.distributions = dict()
-        self.values = dict()
+        self._lazy = lazy
+        self._n_jobs = n_jobs
+        self._sketch_threshold = sketch_threshold
+        self.sketches = dict()
 
         if percentiles is not None:
             self._percentiles = percentiles
         else:
             self._percentiles = [round(x*0.1,1) for x in range(0,11)]
 
-        self.description = self._data.describe(percentiles = self._percentiles)
+        if lazy:
+            self._data = data
+            self._description = None
+            self.distributions = _LazyColumns(self.columns, self._get_native_distribution)
+            self.values = _LazyColumns(self.columns, lambda col: self.distributions[col][col].tolist())
+        else:
+            self._data = data.copy()
+            self.distributions = dict()
+            self.values = dict()
+            self._description = self._data.describe(percentiles = self._percentiles)
+
+            for col in self.columns:
+                self._data[col] = self._data[col].astype(str)
+                self.distributions[col], self.values[col] = self._get_distribution(col)
+
+    @classmethod
+    def from_chunks(cls,
+                    source,
+                    exclude_columns:List[str] = None,
+                    include_columns:List[str] = None,
+                    percentiles:List[float] = None,
+                    sketch_threshold:int = None,
+                    chunksize:int = 1000000,
+                    **read_kwargs):
+        '''
+        Create a DataDistribution from a dataset that is too large to hold in memory. The data is read in chunks and
+        each chunk is added to a mergeable summary (see DataDistribution.partial), from which the distributions, values
+        and description are built. The description covers the numeric columns. Its percentiles other than 0% and 100%
+        are estimated with a quantile sketch (which is exact until a column has more values than the sketch holds),
+        but all other statistics and, unless sketch_threshold is used, the distributions are exact.
+        Args:
+            source: (str or iterable of DataFrames) A path to a CSV file, a Parquet file, or a directory containing a
+                partitioned Parquet dataset. Alternatively, an iterable of DataFrame chunks.
+            exclude_columns: (List[str]) (optional) Columns to exclude from the distribution analysis.
+            include_columns: (List[str]) (optional) Columns to include in the distribution analysis. If supplied, only
+                these columns are read.
+            percentiles: (List[float]) (optional) The percentiles to include in description.
+            sketch_threshold: (int) (optional) Columns with more than sketch_threshold distinct values are summarized
+                approximately. See DataDistribution.
+            chunksize: (int) The number of rows to read from file at a time. Default is 1,000,000.
+            read_kwargs: Additional keyword arguments passed to pandas.read_csv when reading a CSV file.
+
+        Returns: A DataDistribution object.
+
+        Examples:
+            >>> hs6_dd = DataDistribution.from_chunks('D:/data/hs6_panel.csv', include_columns=['hs6', 'year'])
+        '''
+        partial = cls.partial(source, exclude_columns=exclude_columns, include_columns=include_columns,
+                              sketch_threshold=sketch_threshold, chunksize=chunksize, **read_kwargs)
+        return cls.from_partials([partial], percentiles=percentiles)
+
+    @staticmethod
+    def partial(source,
+                exclude_columns:List[str] = None,
+                include_columns:List[str] = None,
+                sketch_threshold:int = None,
+                chunksize:int = 1000000,
+                **read_kwargs):
+        '''
+        Summarize one source (e.g. one file or partition of a dataset) as a DistributionPartial. Partials of different
+        sources can be computed in separate processes and combined with DataDistribution.from_partials.
+        Args:
+            source: (str, DataFrame, or iterable of DataFrames) The data to summarize. See DataDistribution.from_chunks.
+            exclude_columns: (List[str]) (optional) Columns to exclude from the distribution analysis.
+            include_columns: (List[str]) (optional) Columns to include in the distribution analysis.
+            sketch_threshold: (int) (optional) See DataDistribution.
+            chunksize: (int) The number of rows to read from file at a time. Default is 1,000,000.
+            read_kwargs: Additional keyword arguments passed to pandas.read_csv when reading a CSV file.
+
+        Returns: A DistributionPartial object.
+
+        Examples:
+            >>> from concurrent.futures import ProcessPoolExecutor
+            >>> with ProcessPoolExecutor() as executor:
+            >>>     partials = list(executor.map(DataDistribution.partial, yearly_files))
+            >>> panel_dd = DataDistribution.from_partials(partials)
+        '''
+        try:
+            from data_analysis.chunk_io import iter_chunks
+        except ImportError:
+            from chunk_io import iter_chunks
+        partial = DistributionPartial(exclude_columns=exclude_columns, include_columns=include_columns,
+                                      sketch_threshold=sketch_threshold)
+        for chunk in iter_chunks(source, columns=include_columns, chunksize=chunksize, **read_kwargs):
+            partial.update(chunk)
+        return partial
+
+    @classmethod
+    def from_partials(cls,
+                      partials:list,
+                      percentiles:List[float] = None):
+        '''
+        Create a DataDistribution by merging DistributionPartial objects (see DataDistribution.partial).
+        Args:
+            partials: (List[DistributionPartial]) The partial summaries to combine. They are not modified.
+            percentiles: (List[float]) (optional) The percentiles to include in description.
+
+        Returns: A DataDistribution object.
+        '''
+        partial = reduce(lambda combined, other: combined.merge(other), partials[1:], copy.deepcopy(partials[0]))
+        distribution = cls.__new__(cls)
+        distribution.columns = partial.columns
+        distribution._lazy = False
+        distribution._n_jobs = None
+        distribution._data = None
+        distribution._sketch_threshold = partial.sketch_threshold
+        if percentiles is not None:
+            distribution._percentiles = percentiles
+        else:
+            distribution._percentiles = [round(x*0.1,1) for x in range(0,11)]
+        distribution.sketches = partial.sketches if partial.sketch_threshold is not None else dict()
+        distribution.distributions = dict()
+        distribution.values = dict()
+        for col in distribution.columns:
+            sketch = partial.sketches[col]
+            distribution.distributions[col] = cls._distribution_table(col, sketch.value_counts(),
+                                                                      sort=not sketch.approximate)
+            distribution.values[col] = distribution.distributions[col][col].tolist()
+        distribution._description = partial.describe(distribution._percentiles)
+        return distribution
 
-        for col in self.columns:
-            self._data[col] = self._data[col].astype(str)
-            self.distributions[col], self.values[col] = self._get_distribution(col)
+    @property
+    def description(self):
+        if self._description is None:
+            self._description = self._data.describe(percentiles = self._percentiles)
+        return self._description
 
     def _get_distribution(self,
                           column):
@@ -244,10 +871,156 @@ class DataDistribution(object):
 
         return temp_data, codes
 
-    def to_excel(self, path:str):
-        writer = pd.ExcelWriter(path, engine='xlsxwriter')
-        self.description.to_excel(writer, sheet_name = 'Distibutions', index = True)
-        for column in self.distributions.keys():
-            self.distributions[column].to_excel(writer, sheet_name = column, index = False)
+    def _get_native_distribution(self,
+                                 column):
+        if self._sketch_threshold is None:
+            return self._distribution_table(column, self._data[column].value_counts(dropna=False, sort=False))
+        try:
+            from data_analysis.sketches import ColumnSketch
+        except ImportError:
+            from sketches import ColumnSketch
+        sketch = ColumnSketch(threshold=self._sketch_threshold)
+        # Feed the column in slices so a near-unique column never builds a full frequency table
+        for start in range(0, max(len(self._data), 1), _SKETCH_SLICE_ROWS):
+            sketch.update(self._data[column].iloc[start:start + _SKETCH_SLICE_ROWS])
+        self.sketches[column] = sketch
+        if sketch.approximate:
+            return self._distribution_table(column, sketch.value_counts(), sort=False)
+        return self._distribution_table(column, sketch.value_counts())
+
+    @staticmethod
+    def _distribution_table(column, counts, sort:bool = True):
+        if sort:
+            try:
+                counts = counts.sort_index()
+            except TypeError:
+                # Values of mixed types cannot be compared, so order them by their string representation
+                counts = counts.iloc[np.argsort(counts.index.astype(str).to_numpy(), kind='stable')]
+        distribution = pd.DataFrame({column: counts.index, 'count': counts.to_numpy()})
+        # Missing values have no length, so use a nullable integer rather than letting the lengths become floats
+        distribution['string_length'] = distribution[column].astype(str).str.len().astype('Int64')
+        return distribution
+
+    def compute(self, columns:List[str] = None):
+        if not self._lazy:
+            return None
+        if columns is None:
+            columns = self.columns
+        pending = [col for col in columns if not self.distributions.is_computed(col)]
+        if self._n_jobs is not None and self._n_jobs > 1 and len(pending) > 1:
+            with ThreadPoolExecutor(max_workers=min(self._n_jobs, len(pending))) as executor:
+                list(executor.map(self.distributions.__getitem__, pending))
+        else:
+            for col in pending:
+                self.distributions[col]
+        return None
+
+    def to_excel(self, path:str, overflow:str = 'truncate', sidecar:str = None):
+        try:
+            from data_analysis.MultiSheetExcel import open_workbook, write_sheet
+        except ImportError:
+            from MultiSheetExcel import open_workbook, write_sheet
+        self.compute()
+        workbook = open_workbook(path)
+        try:
+            write_sheet(workbook, self.description, 'Distibutions', index = True)
+            for column in self.distributions.keys():
+                write_sheet(workbook, self.distributions[column], str(column), overflow = overflow, sidecar = sidecar)
+        finally:
+            workbook.close()
+
+
+class _LazyColumns(Mapping):
+    '''
+    A read-only dictionary keyed by column name whose values are computed by compute(column) on first access.
+    '''
+    def __init__(self, columns, compute):
+        self._columns = list(columns)
+        self._compute = compute
+        self._computed = dict()
+
+    def __getitem__(self, column):
+        if column not in self._computed:
+            if column not in self._columns:
+                raise KeyError(column)
+            self._computed[column] = self._compute(column)
+        return self._computed[column]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def is_computed(self, column):
+        return column in self._computed
+
+
+class DistributionPartial(object):
+    def __init__(self,
+                 exclude_columns:List[str] = None,
+                 include_columns:List[str] = None,
+                 sketch_threshold:int = None):
+        '''
+        A mergeable summary of the distributions and summary statistics of part of a dataset, used to build a
+        DataDistribution from data that is read in chunks or spread across files. See DataDistribution.partial.
+        Args:
+            exclude_columns: (List[str]) (optional) Columns to exclude from the distribution analysis.
+            include_columns: (List[str]) (optional) Columns to include in the distribution analysis. The default is to
+                include all columns.
+            sketch_threshold: (int) (optional) See DataDistribution.
+        Attributes:
+            columns: (list) The columns with distribution info, in the order they were first seen.
+            sketches: (Dict[ColumnSketch]) The value counts of each column, keyed by column name.
+            numeric: (Dict[NumericSummary]) The summary statistics of each numeric column, keyed by column name.
+        Methods:
+            update(self, data)
+                Adds a DataFrame (chunk) to the summary.
+            merge(self, other)
+                Adds the data summarized by another DistributionPartial.
+            describe(self, percentiles)
+                Returns a DataFrame like DataFrame.describe for the numeric columns.
+        '''
+        self._exclude_columns = exclude_columns if exclude_columns else []
+        self._include_columns = include_columns
+        self.sketch_threshold = sketch_threshold
+        self.columns = list()
+        self.sketches = dict()
+        self.numeric = dict()
+
+    def update(self, data:DataFrame):
+        try:
+            from data_analysis.sketches import ColumnSketch, NumericSummary
+        except ImportError:
+            from sketches import ColumnSketch, NumericSummary
+        if self._include_columns:
+            using_columns = self._include_columns
+        else:
+            using_columns = [col for col in data.columns.tolist() if col not in self._exclude_columns]
+        for col in using_columns:
+            if col not in self.sketches:
+                self.columns.append(col)
+                self.sketches[col] = ColumnSketch(threshold=self.sketch_threshold)
+            self.sketches[col].update(data[col])
+        # Like DataFrame.describe, summary statistics cover all of the numeric columns
+        for col in data.columns:
+            if pd.api.types.is_numeric_dtype(data[col]) and not pd.api.types.is_bool_dtype(data[col]):
+                self.numeric.setdefault(col, NumericSummary()).update(data[col])
+        return self
+
+    def merge(self, other):
+        for col in other.columns:
+            if col in self.sketches:
+                self.sketches[col].merge(other.sketches[col])
+            else:
+                self.columns.append(col)
+                self.sketches[col] = copy.deepcopy(other.sketches[col])
+        for col, summary in other.numeric.items():
+            if col in self.numeric:
+                self.numeric[col].merge(summary)
+            else:
+                self.numeric[col] = copy.deepcopy(summary)
+        return self
 
-        writer.save()
+    def describe(self, percentiles:List[float] = None):
+        return pd.DataFrame({col: summary.describe(percentiles) for col, summary in self.numeric.items()})
@@ -0,0 +1,99 @@
+__Project__ = "economic_analysis_tools"
+__Description__ = '''Encode identifier columns (countries, years, sectors) as compact integer codes.'''
+
+import numpy as np
+import pandas as pd
+
+
+class KeyEncoder(object):
+    def __init__(self, shared_vocabularies: dict = None):
+        '''
+        A class that factorizes identifier columns into compact integer codes so that grouping, masking, and merging
+        can be done on integers rather than strings. Labels are assigned codes in the order they are first seen and
+        the vocabularies grow as new data is encoded, so codes remain consistent across chunks of a dataset. Missing
+        values are given the code -1.
+        Args:
+            shared_vocabularies: (dict) (optional) A dictionary mapping column names to a vocabulary name. Columns with
+                the same vocabulary name share codes (e.g. {'importer': 'country', 'exporter': 'country'}). Other
+                columns get their own vocabulary.
+        Attributes:
+            vocabularies: (Dict[pd.Index]) A dictionary keyed by vocabulary name containing the labels of each code.
+        Methods:
+            encode(self, data, columns)
+                Returns a dictionary of integer code arrays keyed by column name.
+            decode(self, column, codes)
+                Returns the labels corresponding to an array of codes.
+            vocabulary(self, column)
+                Returns the labels of every code of a column.
+
+        Examples:
+            >>> encoder = KeyEncoder({'importer': 'country', 'exporter': 'country'})
+            >>> codes = encoder.encode(gravity_data, ['importer', 'exporter', 'year'])
+            >>> encoder.decode('importer', codes['importer'][0:5])
+        '''
+        self._shared_vocabularies = dict() if shared_vocabularies is None else shared_vocabularies
+        self.vocabularies = dict()
+
+    def _vocabulary_name(self, column):
+        return self._shared_vocabularies.get(column, column)
+
+    def encode(self, data, columns, extend: bool = True):
+        '''
+        Encode columns of a DataFrame as integer codes.
+        Args:
+            data: (pd.DataFrame) A DataFrame containing the columns to encode.
+            columns: (List[str]) The columns to encode.
+            extend: (bool) If True (default), labels that have not been seen before are added to the vocabulary. If
+                False, they are given the code -1.
+
+        Returns: (Dict[np.ndarray]) A dictionary of integer code arrays keyed by column name.
+        '''
+        codes = dict()
+        for column in columns:
+            name = self._vocabulary_name(column)
+            # Factorize the column once and look up only its distinct labels in the vocabulary. A missing label is
+            # never added to the vocabulary, so it is looked up as -1.
+            column_codes, labels = pd.factorize(data[column], use_na_sentinel=False)
+            vocabulary = self.vocabularies.get(name, pd.Index([], dtype=labels.dtype))
+            label_codes = vocabulary.get_indexer(labels)
+            unseen = (label_codes == -1) & labels.notna()
+            if extend and unseen.any():
+                label_codes[unseen] = np.arange(len(vocabulary), len(vocabulary) + unseen.sum())
+                vocabulary = vocabulary.append(labels[unseen])
+                self.vocabularies[name] = vocabulary
+            codes[column] = label_codes.astype(self._code_dtype(vocabulary)).take(column_codes)
+        return codes
+
+    def _code_dtype(self, vocabulary):
+        if len(vocabulary) < np.iinfo(np.int16).max:
+            return np.int16
+        if len(vocabulary) < np.iinfo(np.int32).max:
+            return np.int32
+        return np.int64
+
+    def vocabulary(self, column):
+        '''
+        Return the labels of a column's vocabulary, in which the position of each label is its code.
+        Args:
+            column: (str) The name of an encoded column.
+
+        Returns: (pd.Index) The labels of the column's vocabulary. The index is empty if nothing has been encoded.
+        '''
+        return self.vocabularies.get(self._vocabulary_name(column), pd.Index([]))
+
+    def decode(self, column, codes):
+        '''
+        Decode an array of integer codes back to labels.
+        Args:
+            column: (str) The name of the column that was encoded.
+            codes: (array-like) Integer codes produced by encode().
+
+        Returns: (pd.Index) The labels corresponding to the codes.
+        '''
+        codes = np.asarray(codes)
+        vocabulary = self.vocabularies[self._vocabulary_name(column)]
+        missing = codes == -1
+        if missing.any():
+            vocabulary = vocabulary.insert(len(vocabulary), np.nan)
+            codes = np.where(missing, len(vocabulary) - 1, codes)
+        return vocabulary.take(codes)
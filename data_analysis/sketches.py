@@ -0,0 +1,387 @@
+__Project__ = "economic_analysis_tools"
+__Description__ = '''Mergeable approximate summaries (sketches) of large or high-cardinality columns.'''
+
+import numpy as np
+import pandas as pd
+
+
+def _hash_values(values):
+    '''
+    Hash the values of a Series (or array) to unsigned 64 bit integers. Equal values hash equally across chunks.
+    '''
+    return pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy()
+
+
+def _bit_length(values):
+    '''
+    The number of bits needed to represent each value in an array of unsigned 64 bit integers. The two 32 bit halves are
+    handled separately so the floating point logarithm is exact.
+    '''
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    with np.errstate(divide='ignore'):
+        return np.where(high > 0, np.floor(np.log2(high)) + 33,
+                        np.where(low > 0, np.floor(np.log2(low)) + 1, 0)).astype(np.int64)
+
+
+class HyperLogLog(object):
+    def __init__(self, precision: int = 14):
+        '''
+        A HyperLogLog sketch that estimates the number of distinct values in a stream using 2^precision small
+        registers. The relative standard error of the estimate is about 1.04 / sqrt(2^precision), or 0.8% for the
+        default precision of 14.
+        Args:
+            precision: (int) The number of hash bits used to choose a register, between 4 and 18. Default is 14.
+        Methods:
+            update(self, values)
+                Adds an array or Series of values to the sketch.
+            merge(self, other)
+                Adds the values summarized by another HyperLogLog with the same precision.
+            estimate(self)
+                Returns the estimated number of distinct values.
+        '''
+        if not 4 <= precision <= 18:
+            raise ValueError('precision must be between 4 and 18.')
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, values):
+        hashes = _hash_values(values)
+        if len(hashes) == 0:
+            return self
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remainder = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - _bit_length(remainder) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+        return self
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Only HyperLogLog sketches with the same precision can be merged.')
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * registers and empty > 0:
+            # Linear counting is more accurate for small cardinalities
+            estimate = registers * np.log(registers / empty)
+        return float(estimate)
+
+
+class HeavyHitters(object):
+    def __init__(self, capacity: int = 1000):
+        '''
+        A mergeable frequent items (Misra-Gries) summary that keeps counters for at most capacity values. Any value
+        that makes up more than 1 / (capacity + 1) of the stream is guaranteed to be kept, and each kept count
+        underestimates the true count by at most the value of error.
+        Args:
+            capacity: (int) The maximum number of values to keep counts for. Default is 1000.
+        Attributes:
+            counts: (pd.Series) The (lower bound) counts of the kept values, keyed by value.
+            total: (int) The number of values summarized.
+        Methods:
+            update(self, values)
+                Adds an array or Series of values to the summary.
+            merge(self, other)
+                Adds the values summarized by another HeavyHitters.
+            error(self)
+                Returns the maximum amount by which any count is underestimated.
+            top(self, n)
+                Returns the n largest counts.
+        '''
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+        self.total = 0
+
+    def update(self, values):
+        values = pd.Series(values)
+        return self._add_counts(values.value_counts(dropna=False, sort=False), len(values))
+
+    def merge(self, other):
+        return self._add_counts(other.counts, other.total)
+
+    def _add_counts(self, counts, total):
+        if len(self.counts) == 0:
+            combined = counts
+        else:
+            combined = pd.concat([self.counts, counts])
+            combined = combined.groupby(level=0, sort=False, dropna=False).sum()
+        if len(combined) > self.capacity:
+            # Subtracting the (capacity + 1)-th largest count from every counter keeps the summary mergeable
+            cutoff = np.partition(combined.to_numpy(), len(combined) - self.capacity - 1)[
+                len(combined) - self.capacity - 1]
+            combined = combined[combined > cutoff] - cutoff
+        self.counts = combined.astype(np.int64)
+        self.total += int(total)
+        return self
+
+    def error(self):
+        return (self.total - int(self.counts.sum())) / (self.capacity + 1)
+
+    def top(self, n: int = None):
+        counts = self.counts.sort_values(ascending=False, kind='stable')
+        return counts if n is None else counts.iloc[:n]
+
+
+class KLLQuantiles(object):
+    def __init__(self, k: int = 200, seed: int = None):
+        '''
+        A KLL quantile sketch of a stream of numbers. Values are kept in a hierarchy of compactors, where a value at
+        level h stands for 2^h values of the stream. The rank error of a quantile is roughly 1.7 / k.
+        Args:
+            k: (int) The capacity of the top compactor, which controls the accuracy and size. Default is 200.
+            seed: (int) (optional) A seed for the random choices made when compacting.
+        Attributes:
+            count: (int) The number of values summarized.
+            minimum: (float) The smallest value summarized.
+            maximum: (float) The largest value summarized.
+        Methods:
+            update(self, values)
+                Adds an array or Series of numbers to the sketch. Missing values are ignored.
+            merge(self, other)
+                Adds the values summarized by another KLLQuantiles.
+            quantile(self, q)
+                Returns the estimated quantile(s) for a number or list of numbers between 0 and 1.
+        '''
+        self.k = k
+        self.count = 0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self._compactors = [np.empty(0, dtype=np.float64)]
+        self._random = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self._compactors) - level - 1
+        return int(np.ceil((2 / 3) ** depth * self.k)) + 1
+
+    def _compress(self):
+        level = 0
+        while level < len(self._compactors):
+            items = self._compactors[level]
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self._compactors):
+                    self._compactors.append(np.empty(0, dtype=np.float64))
+                items = np.sort(items)
+                # Keep an odd item at this level and promote every other remaining item from a random offset
+                kept = items[len(items) - len(items) % 2:]
+                promoted = items[self._random.integers(2):len(items) - len(items) % 2:2]
+                self._compactors[level] = kept
+                self._compactors[level + 1] = np.concatenate([self._compactors[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.minimum = np.fmin(self.minimum, values.min())
+        self.maximum = np.fmax(self.maximum, values.max())
+        self._compactors[0] = np.concatenate([self._compactors[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        while len(self._compactors) < len(other._compactors):
+            self._compactors.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other._compactors):
+            self._compactors[level] = np.concatenate([self._compactors[level], items])
+        self.count += other.count
+        self.minimum = np.fmin(self.minimum, other.minimum)
+        self.maximum = np.fmax(self.maximum, other.maximum)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        items = np.concatenate(self._compactors)
+        if len(items) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        weights = np.concatenate([np.full(len(level_items), 2 ** level, dtype=np.float64)
+                                  for level, level_items in enumerate(self._compactors)])
+        order = np.argsort(items, kind='stable')
+        items, weights = items[order], weights[order]
+        cumulative = np.cumsum(weights)
+        q = np.asarray(q, dtype=np.float64)
+        # Each item stands for a run of consecutive ranks and is placed in the middle of it. Interpolating linearly at
+        # pandas' rank, q * (n - 1) + 1, then gives exactly the pandas quantile while nothing has been compacted.
+        positions = cumulative - (weights - 1) / 2
+        estimates = np.interp(q * (cumulative[-1] - 1) + 1, positions, items)
+        # The extremes are tracked exactly
+        estimates = np.where(q <= 0, self.minimum, np.where(q >= 1, self.maximum, estimates))
+        return estimates if estimates.ndim else float(estimates)
+
+
+class NumericSummary(object):
+    def __init__(self, k: int = 200, seed: int = None):
+        '''
+        A mergeable summary of a numeric column with the statistics reported by DataFrame.describe. The count, mean,
+        standard deviation, minimum, and maximum are exact, while other percentiles come from a KLL quantile sketch.
+        Args:
+            k: (int) The accuracy parameter of the quantile sketch. Default is 200.
+            seed: (int) (optional) A seed for the quantile sketch.
+        Methods:
+            update(self, values)
+                Adds an array or Series of numbers to the summary. Missing values are ignored.
+            merge(self, other)
+                Adds the values summarized by another NumericSummary.
+            describe(self, percentiles)
+                Returns a Series with the count, mean, std, min, percentiles, and max.
+        '''
+        self.count = 0
+        self.mean = 0.0
+        self._sum_squares = 0.0
+        self._quantiles = KLLQuantiles(k, seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) > 0:
+            other = NumericSummary.__new__(NumericSummary)
+            other.count = len(values)
+            other.mean = float(values.mean())
+            other._sum_squares = float(np.sum((values - other.mean) ** 2))
+            self._merge_moments(other)
+            self._quantiles.update(values)
+        return self
+
+    def merge(self, other):
+        self._merge_moments(other)
+        self._quantiles.merge(other._quantiles)
+        return self
+
+    def _merge_moments(self, other):
+        # Chan et al.'s pairwise update of the mean and sum of squared deviations
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self._sum_squares += other._sum_squares + delta ** 2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+
+    def describe(self, percentiles: list = None):
+        percentiles = sorted(set([0.25, 0.5, 0.75] if percentiles is None else list(percentiles)) | {0.5})
+        if self.count == 0:
+            statistics = [0.0] + [np.nan] * (len(percentiles) + 4)
+        else:
+            std = np.sqrt(self._sum_squares / (self.count - 1)) if self.count > 1 else np.nan
+            statistics = ([float(self.count), self.mean, std, self._quantiles.minimum] +
+                          list(self._quantiles.quantile(percentiles)) + [self._quantiles.maximum])
+        # Label the statistics exactly as DataFrame.describe does
+        labels = pd.Series([0.0]).describe(percentiles=percentiles).index
+        return pd.Series(statistics, index=labels, dtype=np.float64)
+
+
+class ColumnSketch(object):
+    def __init__(self,
+                 threshold: int = 100000,
+                 capacity: int = 1000,
+                 k: int = 200,
+                 precision: int = 14,
+                 seed: int = None):
+        '''
+        A mergeable summary of a column. Value counts are kept exactly until the column has more than threshold
+        distinct values, after which only the capacity most frequent values are tracked (HeavyHitters). Distinct
+        values are also counted with a HyperLogLog sketch and numeric columns are summarized with a KLL quantile
+        sketch.
+        Args:
+            threshold: (int) The number of distinct values above which counts become approximate. If None, counts are
+                always exact. Default is 100000.
+            capacity: (int) The number of frequent values tracked once counts are approximate. Default is 1000.
+            k: (int) The accuracy parameter of the quantile sketch. Default is 200.
+            precision: (int) The precision of the distinct count sketch. Default is 14.
+            seed: (int) (optional) A seed for the quantile sketch.
+        Attributes:
+            approximate: (bool) True if the value counts are approximate.
+            count: (int) The number of values summarized, including missing values.
+            missing: (int) The number of missing values.
+        Methods:
+            update(self, values)
+                Adds a Series of values to the summary.
+            merge(self, other)
+                Adds the values summarized by another ColumnSketch.
+            distinct(self)
+                Returns the (estimated, if approximate) number of distinct non-missing values.
+            value_counts(self)
+                Returns the exact counts or the counts of the most frequent values, keyed by value.
+            quantile(self, q)
+                Returns the estimated quantile(s) of a numeric column.
+        '''
+        self.threshold = threshold
+        self.approximate = False
+        self.count = 0
+        self.missing = 0
+        self._counts = pd.Series(dtype=np.int64)
+        self._heavy_hitters = HeavyHitters(capacity)
+        self._distinct = HyperLogLog(precision)
+        self._quantiles = KLLQuantiles(k, seed)
+        self._numeric = None
+
+    def update(self, values):
+        values = pd.Series(values)
+        present = values.dropna()
+        self.count += len(values)
+        self.missing += len(values) - len(present)
+        self._distinct.update(present)
+        self._update_numeric(pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values))
+        if self._numeric:
+            self._quantiles.update(present.to_numpy(dtype=np.float64))
+        counts = values.value_counts(dropna=False, sort=False)
+        if self.approximate:
+            self._heavy_hitters._add_counts(counts, len(values))
+        else:
+            self._add_exact_counts(counts)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.missing += other.missing
+        self._distinct.merge(other._distinct)
+        self._update_numeric(other._numeric)
+        if self._numeric:
+            self._quantiles.merge(other._quantiles)
+        if other.approximate:
+            self._switch_to_approximate()
+            self._heavy_hitters.merge(other._heavy_hitters)
+        elif self.approximate:
+            self._heavy_hitters._add_counts(other._counts, int(other._counts.sum()))
+        else:
+            self._add_exact_counts(other._counts)
+        return self
+
+    def _update_numeric(self, numeric):
+        if numeric is not None:
+            self._numeric = numeric if self._numeric is None else self._numeric and numeric
+
+    def _add_exact_counts(self, counts):
+        if len(self._counts) == 0:
+            self._counts = counts
+        else:
+            self._counts = pd.concat([self._counts, counts]).groupby(level=0, sort=False, dropna=False).sum()
+        if self.threshold is not None and len(self._counts) > self.threshold:
+            self._switch_to_approximate()
+
+    def _switch_to_approximate(self):
+        if not self.approximate:
+            self.approximate = True
+            self._heavy_hitters._add_counts(self._counts, int(self._counts.sum()))
+            self._counts = pd.Series(dtype=np.int64)
+
+    def distinct(self):
+        if self.approximate:
+            return int(round(self._distinct.estimate()))
+        return int(self._counts.index.notna().sum())
+
+    def value_counts(self):
+        if self.approximate:
+            return self._heavy_hitters.top()
+        return self._counts
+
+    def quantile(self, q):
+        if not self._numeric:
+            raise TypeError('Quantiles are only available for numeric columns.')
+        return self._quantiles.quantile(q)
@@ -1,41 +1,287 @@
 __Author__ = "Peter Herman"
 __Project__ = "misc_tools"
 __Created__ = "February 25, 2020"
-__Description__ = ''' '''
+__Description__ = '''Tools for measuring how the runtime and memory use of a function scale with the size of its input
+    and projecting them to a larger (production) input size.'''
 
+import gc
+import time
+import tracemalloc
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-import timeit
-from numba import jit
-test_func = '''
-def test_function(iter):
-	for i in iter:
-		for j in iter:
-			i == j
-'''
+from scipy.stats import t as t_distribution
 
-@jit
-def numba_test(iter):
-	for i in iter:
-		for j in iter:
-			i == j
+COMPLEXITY_MODELS = {'O(1)': lambda n: np.ones_like(n, dtype=float),
+                     'O(log n)': lambda n: np.log(n),
+                     'O(n)': lambda n: n,
+                     'O(n log n)': lambda n: n * np.log(n),
+                     'O(n^2)': lambda n: n ** 2,
+                     'O(n^3)': lambda n: n ** 3}
 
-a = timeit.timeit(stmt = 'test_function(range(1))', setup=test_func, number=10000)
-b = timeit.timeit(stmt = 'test_function(range(10))', setup=test_func, number=10000)
-c = timeit.timeit(stmt = 'test_function(range(100))', setup=test_func, number=10000)
 
-x = np.array([0,1,2])
-y = np.array([a,b,c])
-z = np.polyfit(x, y, 10)
-print(z)
+def measure_scaling(function,
+                    data_generator,
+                    sizes: list = None,
+                    min_size: int = 1000,
+                    max_size: int = 100000,
+                    number_of_sizes: int = 6,
+                    repeat: int = 3,
+                    measure_memory: bool = True):
+    '''
+    Measure the runtime and peak memory use of a function at a range of input sizes.
+    :param function: (callable) The function to measure. It is called with the output of data_generator.
+    :param data_generator: (callable) A function that takes a size (int) and returns the input for function. Data
+        generation is not included in the measurements.
+    :param sizes: (List[int]) (optional) The sizes at which to measure. If not supplied, number_of_sizes log-spaced
+        sizes between min_size and max_size are used.
+    :param min_size: (int) The smallest size if sizes is not supplied. Default is 1,000.
+    :param max_size: (int) The largest size if sizes is not supplied. Default is 100,000.
+    :param number_of_sizes: (int) The number of sizes if sizes is not supplied. Default is 6.
+    :param repeat: (int) The number of timed runs at each size. The fastest is recorded. Default is 3.
+    :param measure_memory: (bool) If True (default), the peak memory allocated during an additional run is recorded.
+    :return: (DataFrame) A DataFrame with columns 'size', 'seconds', and 'peak_mb' (if measure_memory).
+    '''
+    if sizes is None:
+        sizes = np.unique(np.geomspace(min_size, max_size, number_of_sizes).round().astype(int)).tolist()
+    measurements = list()
+    for size in sizes:
+        data = data_generator(size)
+        times = list()
+        for run in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            function(data)
+            times.append(time.perf_counter() - start)
+        measurement = {'size': size, 'seconds': min(times)}
+        if measure_memory:
+            gc.collect()
+            tracemalloc.start()
+            function(data)
+            measurement['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        measurements.append(measurement)
+    return pd.DataFrame(measurements)
 
-p = np.poly1d(z)
-print(p(0.5)) # Polynomial Function evaluated at 0.5
 
+def fit_complexity(sizes,
+                   values,
+                   models: list = None):
+    '''
+    Fit complexity models of the form value = a + b * f(size) by least squares.
+    :param sizes: (array-like) Input sizes.
+    :param values: (array-like) Measured values (e.g. seconds) at each size.
+    :param models: (List[str]) (optional) Keys of COMPLEXITY_MODELS to fit. The default fits all of them.
+    :return: (DataFrame) A DataFrame indexed by model name with the fitted intercept and slope, the residual standard
+        error, and R^2, sorted from best to worst fit. Models with a negative slope are listed last.
+    '''
+    if models is None:
+        models = list(COMPLEXITY_MODELS.keys())
+    sizes = np.asarray(sizes, dtype=float)
+    values = np.asarray(values, dtype=float)
+    total_variation = ((values - values.mean()) ** 2).sum()
+    fits = list()
+    for model in models:
+        design = _design_matrix(model, sizes)
+        coefficients, _, design_rank, _ = np.linalg.lstsq(design, values, rcond=None)
+        residuals = values - design @ coefficients
+        degrees_of_freedom = max(values.shape[0] - design_rank, 1)
+        fits.append({'model': model,
+                     'intercept': coefficients[0],
+                     'slope': coefficients[1] if design_rank > 1 else 0.0,
+                     'residual_se': np.sqrt((residuals ** 2).sum() / degrees_of_freedom),
+                     'r_squared': 1 - (residuals ** 2).sum() / total_variation if total_variation > 0 else 1.0,
+                     'valid': design_rank == 1 or coefficients[1] >= 0})
+    fits = pd.DataFrame(fits).set_index('model')
+    fits = fits.sort_values(['valid', 'r_squared'], ascending=[False, False])
+    return fits.drop(columns=['valid'])
 
 
+def _design_matrix(model, sizes):
+    '''
+    A private function that returns the regression design matrix [1, f(size)] for a model. The constant model only has
+    an intercept.
+    '''
+    if model == 'O(1)':
+        return np.ones((sizes.shape[0], 1))
+    return np.column_stack([np.ones(sizes.shape[0]), COMPLEXITY_MODELS[model](sizes)])
 
-xp = np.linspace(0, 5, 5)
-_ = plt.plot(x, y, '.', xp, p(xp), '-')
-#plt.ylim(-2,2)
-plt.show()
\ No newline at end of file
+
+def predict_complexity(sizes,
+                       values,
+                       model: str,
+                       target_sizes,
+                       confidence: float = 0.95):
+    '''
+    Fit a complexity model and predict values at new sizes with prediction intervals.
+    :param sizes: (array-like) Input sizes.
+    :param values: (array-like) Measured values at each size.
+    :param model: (str) A key of COMPLEXITY_MODELS.
+    :param target_sizes: (array-like) Sizes at which to predict.
+    :param confidence: (float) The confidence level of the prediction interval. Default is 0.95.
+    :return: (DataFrame) A DataFrame with columns 'size', 'prediction', 'lower', and 'upper'.
+    '''
+    sizes = np.asarray(sizes, dtype=float)
+    values = np.asarray(values, dtype=float)
+    target_sizes = np.atleast_1d(np.asarray(target_sizes, dtype=float))
+    design = _design_matrix(model, sizes)
+    coefficients, _, design_rank, _ = np.linalg.lstsq(design, values, rcond=None)
+    residuals = values - design @ coefficients
+    degrees_of_freedom = max(values.shape[0] - design_rank, 1)
+    residual_variance = (residuals ** 2).sum() / degrees_of_freedom
+    target_design = _design_matrix(model, target_sizes)
+    prediction = target_design @ coefficients
+    leverage = np.einsum('ij,jk,ik->i', target_design, np.linalg.pinv(design.T @ design), target_design)
+    margin = t_distribution.ppf(0.5 + confidence / 2, degrees_of_freedom) * np.sqrt(residual_variance * (1 + leverage))
+    return pd.DataFrame({'size': target_sizes,
+                         'prediction': prediction,
+                         'lower': np.maximum(prediction - margin, 0),
+                         'upper': prediction + margin})
+
+
+def format_duration(seconds: float):
+    '''
+    Format a number of seconds as a readable duration (e.g. '2.5 hours').
+    :param seconds: (float) A duration in seconds.
+    :return: (str) The formatted duration.
+    '''
+    for unit, length in [('days', 86400), ('hours', 3600), ('minutes', 60)]:
+        if seconds >= length:
+            return '{:.1f} {}'.format(seconds / length, unit)
+    return '{:.2f} seconds'.format(seconds)
+
+
+class ScalingProjection(object):
+    def __init__(self,
+                 function,
+                 data_generator,
+                 target_size: int,
+                 sizes: list = None,
+                 min_size: int = 1000,
+                 max_size: int = 100000,
+                 number_of_sizes: int = 6,
+                 repeat: int = 3,
+                 models: list = None,
+                 confidence: float = 0.95,
+                 measure_memory: bool = True):
+        '''
+        Measure how a function scales with the size of its input, fit complexity models (O(n), O(n log n), O(n^2),
+        ...) to the runtime and memory use, and project both to a target size.
+        Args:
+            function: (callable) The function to measure. It is called with the output of data_generator.
+            data_generator: (callable) A function that takes a size (int) and returns the input for function.
+            target_size: (int) The size to project to (e.g. the number of rows in the full production dataset).
+            sizes: (List[int]) (optional) The sizes at which to measure. See measure_scaling().
+            min_size: (int) The smallest size if sizes is not supplied. Default is 1,000.
+            max_size: (int) The largest size if sizes is not supplied. Default is 100,000.
+            number_of_sizes: (int) The number of log-spaced sizes if sizes is not supplied. Default is 6.
+            repeat: (int) The number of timed runs at each size. Default is 3.
+            models: (List[str]) (optional) Keys of COMPLEXITY_MODELS to fit. The default fits all of them.
+            confidence: (float) The confidence level of the projection bands. Default is 0.95.
+            measure_memory: (bool) If True (default), memory use is measured and projected as well.
+        Attributes:
+            measurements: (DataFrame) The measured runtime (and peak memory) at each size.
+            fits: (Dict[DataFrame]) Complexity model fits (see fit_complexity()) keyed by 'seconds' and 'peak_mb'.
+            best_models: (Dict[str]) The best fitting model keyed by 'seconds' and 'peak_mb'.
+            projection: (DataFrame) The projected value and bounds at target_size for each measure using its best model.
+        Methods:
+            summary(self, time_limit=None): Prints the projections and, if a time limit (in seconds) is supplied,
+                whether the job is expected to finish within it.
+            plot(self, path=None, number_of_models=3): Plots the measurements and fitted curves with confidence bands.
+
+        Examples:
+            >>> from benchmarks.synthetic_data import gravity_panel
+            >>> from data_analysis.TraderRanking import TraderRanking
+            >>> rank_all = lambda panel: TraderRanking(panel, sector_var_name='sector').ranking(by_year=True,
+                                                                                              by_sector=True)
+            >>> panel_of_size = lambda n: gravity_panel(50, max(n // (50 * 50 * 10), 1), 10)
+            >>> projection = ScalingProjection(rank_all, panel_of_size, target_size=250 * 250 * 5000 * 30,
+                                               min_size=25000, max_size=2500000)
+            >>> projection.summary(time_limit=12 * 3600)
+            >>> projection.plot('ranking_projection.png')
+        '''
+        self.target_size = target_size
+        self.confidence = confidence
+        self.models = list(COMPLEXITY_MODELS.keys()) if models is None else models
+        self.measurements = measure_scaling(function, data_generator, sizes, min_size, max_size, number_of_sizes,
+                                            repeat, measure_memory)
+        self._measures = ['seconds', 'peak_mb'] if measure_memory else ['seconds']
+        self.fits = dict()
+        self.best_models = dict()
+        projections = list()
+        for measure in self._measures:
+            self.fits[measure] = fit_complexity(self.measurements['size'], self.measurements[measure], self.models)
+            self.best_models[measure] = self.fits[measure].index[0]
+            projection = predict_complexity(self.measurements['size'], self.measurements[measure],
+                                            self.best_models[measure], [target_size], confidence)
+            projection.insert(0, 'model', self.best_models[measure])
+            projection.index = [measure]
+            projections.append(projection)
+        self.projection = pd.concat(projections)
+
+    def summary(self, time_limit: float = None):
+        '''
+        Print the projected runtime and memory use at the target size.
+        :param time_limit: (float) (optional) A time limit in seconds (e.g. 12 * 3600 for an overnight run).
+        :return: None
+        '''
+        seconds = self.projection.loc['seconds', :]
+        print('Projection to size {:,} ({:.0%} confidence):'.format(self.target_size, self.confidence))
+        print('  Runtime: {} ({}), range {} to {}'.format(format_duration(seconds['prediction']), seconds['model'],
+                                                          format_duration(seconds['lower']),
+                                                          format_duration(seconds['upper'])))
+        if 'peak_mb' in self.projection.index:
+            memory = self.projection.loc['peak_mb', :]
+            print('  Peak memory: {:,.1f} MB ({}), range {:,.1f} to {:,.1f} MB'.format(
+                memory['prediction'], memory['model'], memory['lower'], memory['upper']))
+        if time_limit is not None:
+            if seconds['upper'] <= time_limit:
+                verdict = 'is expected to finish'
+            elif seconds['prediction'] <= time_limit:
+                verdict = 'may finish'
+            else:
+                verdict = 'is not expected to finish'
+            print('  The job {} within the time limit of {}.'.format(verdict, format_duration(time_limit)))
+        return None
+
+    def plot(self, path: str = None, number_of_models: int = 3):
+        '''
+        Plot the measurements and the fitted complexity curves, with confidence bands, out to the target size.
+        :param path: (str) (optional) A path and file name at which to save the plot (e.g. .png, .pdf, or .svg).
+        :param number_of_models: (int) The number of best fitting models to plot for each measure. Default is 3.
+        :return: (matplotlib.figure.Figure) The figure.
+        '''
+        figure, axes = plt.subplots(1, len(self._measures), figsize=(6 * len(self._measures), 5), squeeze=False)
+        plot_sizes = np.geomspace(self.measurements['size'].min(), self.target_size, 200)
+        labels = {'seconds': 'Runtime (seconds)', 'peak_mb': 'Peak memory (MB)'}
+        for axis, measure in zip(axes[0], self._measures):
+            axis.plot(self.measurements['size'], self.measurements[measure], 'o', color='black', label='Measured')
+            for model in self.fits[measure].index[0:number_of_models]:
+                curve = predict_complexity(self.measurements['size'], self.measurements[measure], model, plot_sizes,
+                                           self.confidence)
+                line = axis.plot(curve['size'], curve['prediction'], '-', label=model)
+                axis.fill_between(curve['size'], curve['lower'], curve['upper'], color=line[0].get_color(), alpha=0.2)
+            axis.axvline(self.target_size, color='grey', linestyle='--', label='Target size')
+            axis.set_xscale('log')
+            axis.set_yscale('log')
+            axis.set_xlabel('Size')
+            axis.set_ylabel(labels[measure])
+            axis.legend()
+        figure.tight_layout()
+        if path is not None:
+            figure.savefig(path)
+        return figure
+
+
+if __name__ == '__main__':
+    def test_function(iter):
+        for i in iter:
+            for j in iter:
+                i == j
+
+    projection = ScalingProjection(test_function, range, target_size=100000, min_size=10, max_size=1000,
+                                   number_of_sizes=6, repeat=3, measure_memory=False)
+    print(projection.fits['seconds'])
+    projection.summary(time_limit=60)
+    projection.plot()
+    plt.show()
@@ -0,0 +1,58 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from data_analysis.TraderRanking import TraderRanking
+
+GROUPINGS = [(by_year, by_sector) for by_year in [False, True] for by_sector in [False, True]]
+
+
+def gravity_data(years, sectors, seed):
+    # Labels first appear out of alphabetical order so that label and first-appearance orders differ
+    countries = ['USA', 'CHN', 'FRA', 'BRA']
+    rows = [(imp, exp, year, sector) for year, sector, imp, exp in itertools.product(years, sectors, countries,
+                                                                                      countries) if imp != exp]
+    data = pd.DataFrame(rows, columns=['importer', 'exporter', 'year', 'sector'])
+    data['trade_value'] = np.random.default_rng(seed).permutation(data.shape[0]) + 1.0
+    return data
+
+
+@pytest.mark.parametrize('encode_keys', [False, True])
+def test_update_matches_full_rebuild_in_long_format(encode_keys):
+    old_rows = gravity_data([2002, 2001], ['S2', 'S1'], seed=0)
+    new_rows = gravity_data([2000], ['S2', 'S0'], seed=1)
+    updated = TraderRanking(old_rows, sector_var_name='sector', encode_keys=encode_keys)
+    for flow, (by_year, by_sector) in itertools.product(['imports', 'exports', 'both'], GROUPINGS):
+        updated.ranking(flow, by_year=by_year, by_sector=by_sector)
+    updated.update(new_rows)
+    rebuilt = TraderRanking(pd.concat([old_rows, new_rows], ignore_index=True), sector_var_name='sector',
+                            encode_keys=encode_keys)
+
+    for flow, (by_year, by_sector) in itertools.product(['imports', 'exports', 'both'], GROUPINGS):
+        pd.testing.assert_frame_equal(updated.ranking(flow, by_year, by_sector, long_format=True),
+                                      rebuilt.ranking(flow, by_year, by_sector, long_format=True))
+        pd.testing.assert_frame_equal(updated.membership(flow, country_number=2, cumulative_percentage=0.5,
+                                                         by_year=by_year, by_sector=by_sector),
+                                      rebuilt.membership(flow, country_number=2, cumulative_percentage=0.5,
+                                                         by_year=by_year, by_sector=by_sector))
+
+
+@pytest.mark.parametrize('encode_keys', [False, True])
+def test_retract_matches_full_rebuild_in_long_format(encode_keys):
+    data = pd.concat([gravity_data([2002, 2001], ['S2', 'S1'], seed=0), gravity_data([2000], ['S2', 'S0'], seed=1)],
+                     ignore_index=True)
+    # The retracted rows are the first rows of the data, in which sector S2 first appears
+    old_rows = data.loc[(data['year'] == 2002) & (data['sector'] == 'S2'), :]
+    retracted = TraderRanking(data, sector_var_name='sector', encode_keys=encode_keys)
+    for flow, (by_year, by_sector) in itertools.product(['imports', 'exports', 'both'], GROUPINGS):
+        retracted.ranking(flow, by_year=by_year, by_sector=by_sector)
+    retracted.retract(old_rows)
+    rebuilt = TraderRanking(data.drop(index=old_rows.index), sector_var_name='sector', encode_keys=encode_keys)
+
+    for flow, (by_year, by_sector) in itertools.product(['imports', 'exports', 'both'], GROUPINGS):
+        assert retracted.ranking(flow, by_year, by_sector, long_format=True).equals(
+            rebuilt.ranking(flow, by_year, by_sector, long_format=True))
+        pd.testing.assert_frame_equal(retracted.membership(flow, country_number=2, cumulative_percentage=0.5,
+                                                           by_year=by_year, by_sector=by_sector),
+                                      rebuilt.membership(flow, country_number=2, cumulative_percentage=0.5,
+                                                         by_year=by_year, by_sector=by_sector))